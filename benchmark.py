@@ -0,0 +1,469 @@
+﻿"""Speed and accuracy benchmark on synthetic Synthesia-style videos.
+
+Renders falling-note/keyboard videos from a known MIDI file (generated with a
+fixed seed, or given with --midi), converts them with VideoProcessor and
+reports conversion fps, peak RSS and note-level precision/recall against the
+ground truth. Results are saved as JSON so two versions can be compared:
+
+    python benchmark.py -o results.json
+    python benchmark.py --case 720p30 --case 720p30-particles -o quick.json
+    python benchmark.py --width 1920 --height 1080 --fps 60 --particles 40 -o custom.json
+    python benchmark.py -o new.json --compare results.json
+    python benchmark.py --backend opencv --backend pyav --backend ffmpeg -o backends.json
+"""
+import argparse
+import hashlib
+import json
+import logging
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+
+import cv2
+import numpy as np
+from mido import Message, MidiFile, MidiTrack
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from core import VideoProcessor
+from decoders import BACKENDS
+from profiler import StageProfiler
+
+try:
+    import resource # Unix only
+except ImportError:
+    resource = None
+
+BENCH_BPM = 120 # Ground truth and conversions share the tempo, so MIDI seconds line up
+TICKS_PER_BEAT = 480
+BLACK_PITCH_CLASSES = (1, 3, 6, 8, 10)
+
+CASE_DEFAULTS = {
+    "width": 1280, "height": 720, "fps": 30, "codec": "MJPG",
+    "particles": 0, "keys": 88, "start_key": 21,
+    "duration": 10.0, "notes_per_second": 6.0, "seed": 0,
+}
+
+SUITE = [
+    {"name": "720p30"},
+    {"name": "720p30-particles", "particles": 40},
+    {"name": "1080p60", "width": 1920, "height": 1080, "fps": 60},
+    {"name": "1080p60-particles", "width": 1920, "height": 1080, "fps": 60, "particles": 60},
+    {"name": "720p30-61keys-mp4v", "keys": 61, "start_key": 36, "codec": "mp4v"},
+]
+
+def make_case(overrides):
+    case = dict(CASE_DEFAULTS)
+    case.update(overrides)
+    if "name" not in case:
+        case["name"] = f"{case['width']}x{case['height']}@{case['fps']}-{case['keys']}keys-p{case['particles']}-{case['codec']}"
+    return case
+
+# --- Ground truth ---
+
+def generate_notes(case):
+    """Random non-overlapping notes as (midi_note, on_frame, off_frame), sorted by onset.
+
+    Notes of the same key keep a few frames apart so the debounce can resolve them.
+    """
+    rng = np.random.default_rng(case["seed"])
+    fps = case["fps"]
+    n_frames = int(case["duration"] * fps)
+    lead_in = fps # First second stays untouched: the keyboard is calibrated on frame 0
+    min_len, max_len = max(3, fps // 10), max(4, fps)
+    min_gap = max(3, fps // 15)
+
+    busy = {} # key -> list of (on, off)
+    notes = []
+    target = int(case["duration"] * case["notes_per_second"])
+    for _ in range(target * 20):
+        if len(notes) >= target:
+            break
+        key = case["start_key"] + int(rng.integers(0, case["keys"]))
+        on = int(rng.integers(lead_in, n_frames - min_len - 1))
+        off = min(n_frames - 1, on + int(rng.integers(min_len, max_len + 1)))
+        if any(on < b + min_gap and a < off + min_gap for a, b in busy.get(key, [])):
+            continue
+        busy.setdefault(key, []).append((on, off))
+        notes.append((key, on, off))
+    notes.sort(key=lambda n: (n[1], n[0]))
+    return notes
+
+def write_notes_midi(notes, fps, path):
+    """Writes frame-based notes as a MIDI file at BENCH_BPM."""
+    ticks_per_second = TICKS_PER_BEAT * BENCH_BPM / 60.0
+    events = []
+    for note, on, off in notes:
+        events.append((round(on / fps * ticks_per_second), 1, note, 'note_on'))
+        events.append((round(off / fps * ticks_per_second), 0, note, 'note_off'))
+    events.sort()
+
+    mid = MidiFile(ticks_per_beat=TICKS_PER_BEAT)
+    track = MidiTrack()
+    mid.tracks.append(track)
+    last_tick = 0
+    for tick, _, note, kind in events:
+        track.append(Message(kind, note=note, velocity=64, time=tick - last_tick))
+        last_tick = tick
+    mid.save(path)
+
+def read_midi_notes(path):
+    """Notes of a MIDI file as (midi_note, onset_s, offset_s); unterminated notes end with the file."""
+    notes = []
+    open_notes = {}
+    now = 0.0
+    for msg in MidiFile(path):
+        now += msg.time
+        if msg.type == 'note_on' and msg.velocity > 0:
+            if msg.note in open_notes:
+                notes.append((msg.note, open_notes.pop(msg.note), now))
+            open_notes[msg.note] = now
+        elif msg.type in ('note_off', 'note_on'):
+            if msg.note in open_notes:
+                notes.append((msg.note, open_notes.pop(msg.note), now))
+    for note, onset in open_notes.items():
+        notes.append((note, onset, now))
+    notes.sort(key=lambda n: (n[1], n[0]))
+    return notes
+
+def match_notes(reference, estimated, onset_tolerance):
+    """Note-level scores (onset only): each reference note matches at most one estimate
+    of the same pitch whose onset is within onset_tolerance seconds."""
+    by_pitch = {}
+    for note, onset, _ in estimated:
+        by_pitch.setdefault(note, []).append(onset)
+
+    matched = 0
+    for note, onset, _ in reference:
+        candidates = by_pitch.get(note)
+        if not candidates:
+            continue
+        best = min(range(len(candidates)), key=lambda i: abs(candidates[i] - onset))
+        if abs(candidates[best] - onset) <= onset_tolerance:
+            matched += 1
+            del candidates[best]
+
+    precision = matched / len(estimated) if estimated else 0.0
+    recall = matched / len(reference) if reference else 0.0
+    f1 = 2 * precision * recall / (precision + recall) if precision + recall > 0 else 0.0
+    return {
+        "notes_expected": len(reference), "notes_detected": len(estimated), "matched": matched,
+        "precision": precision, "recall": recall, "f1": f1,
+    }
+
+# --- Rendering ---
+
+def keyboard_layout(case):
+    """Returns [(midi_note, is_black, x_start, x_end)] spanning the frame width."""
+    notes = range(case["start_key"], case["start_key"] + case["keys"])
+    n_white = sum(1 for n in notes if n % 12 not in BLACK_PITCH_CLASSES)
+    white_w = case["width"] / n_white
+    black_w = max(3, int(round(white_w * 0.6)))
+
+    layout = []
+    whites = 0
+    for n in notes:
+        if n % 12 in BLACK_PITCH_CLASSES:
+            center = int(round(whites * white_w))
+            layout.append((n, True, max(0, center - black_w // 2), min(case["width"], center + black_w - black_w // 2)))
+        else:
+            layout.append((n, False, int(round(whites * white_w)), int(round((whites + 1) * white_w))))
+            whites += 1
+    return layout
+
+def video_extension(codec):
+    return ".mp4" if codec.lower() in ("mp4v", "avc1", "h264") else ".avi"
+
+def render_video(case, midi_path, video_path):
+    """Renders the notes of midi_path as a falling-notes video with cv2.VideoWriter."""
+    width, height, fps = case["width"], case["height"], case["fps"]
+    layout = keyboard_layout(case)
+    x_of = {n: (black, x0, x1) for n, black, x0, x1 in layout}
+
+    notes = [(n, int(round(on * fps)), int(round(off * fps)))
+             for n, on, off in read_midi_notes(midi_path) if n in x_of]
+    n_frames = int(case["duration"] * fps)
+
+    kb_top = int(height * 0.70)
+    black_bottom = kb_top + int((height - kb_top) * 0.6)
+    fall_speed = kb_top / (1.5 * fps) # A note is visible 1.5 s before it is played
+    separator = max(1, int(round(case["width"] / len(layout) / 8)))
+
+    white_color, black_color = (255, 255, 255), (0, 0, 0)
+    white_pressed, black_pressed = (230, 140, 60), (180, 100, 40)
+
+    writer = cv2.VideoWriter(video_path, cv2.VideoWriter_fourcc(*case["codec"]), fps, (width, height))
+    if not writer.isOpened():
+        raise ValueError(f"Codec {case['codec']} is not available for {video_path}")
+
+    rng = np.random.default_rng(case["seed"] + 1)
+    particle_radius = max(2, height // 180)
+    try:
+        for f in range(n_frames):
+            img = np.full((height, width, 3), 30, np.uint8)
+            pressed = set()
+
+            # 1. Falling notes above the keyboard (bottom edge reaches it on the note on)
+            for n, on, off in notes:
+                if off <= f:
+                    continue
+                bottom = kb_top - (on - f) * fall_speed
+                top = bottom - (off - on) * fall_speed
+                if top >= kb_top or bottom < 0:
+                    continue
+                if on <= f:
+                    pressed.add(n)
+                black, x0, x1 = x_of[n]
+                cv2.rectangle(img, (x0 + 1, max(0, int(top))), (x1 - 2, min(kb_top - 1, int(bottom))),
+                              black_pressed if black else white_pressed, -1)
+
+            # 2. Keyboard: white keys with dark separators, then black keys on top
+            for n, black, x0, x1 in layout:
+                if not black:
+                    img[kb_top:, x0:x1] = white_pressed if n in pressed else white_color
+                    img[kb_top:, max(x0, x1 - separator):x1] = 90
+            for n, black, x0, x1 in layout:
+                if black:
+                    img[kb_top:black_bottom, x0:x1] = black_pressed if n in pressed else black_color
+
+            # 3. Particles around the hit line (mostly above the detection strip)
+            hits = [x_of[n] for n in pressed]
+            for _ in range(case["particles"]):
+                if hits:
+                    _, x0, x1 = hits[int(rng.integers(0, len(hits)))]
+                    x = int(rng.integers(x0 - (x1 - x0), x1 + (x1 - x0) + 1))
+                else:
+                    x = int(rng.integers(0, width))
+                y = int(rng.integers(kb_top - int(height * 0.15), kb_top + int(height * 0.06)))
+                color = (255, 255, 255) if rng.random() < 0.5 else (255, 220, 150)
+                cv2.circle(img, (x, y), int(rng.integers(1, particle_radius + 1)), color, -1)
+
+            writer.write(img)
+    finally:
+        writer.release()
+
+def prepare_case(case, work_dir, midi_path=None):
+    """Renders (or reuses) the video and ground truth MIDI of a case. Returns (video, midi)."""
+    render_keys = {k: case[k] for k in CASE_DEFAULTS}
+    if midi_path:
+        with open(midi_path, 'rb') as f:
+            render_keys["midi"] = hashlib.sha1(f.read()).hexdigest()
+    digest = hashlib.sha1(json.dumps(render_keys, sort_keys=True).encode()).hexdigest()[:10]
+    base = os.path.join(work_dir, f"{case['name']}_{digest}")
+    video_path = base + video_extension(case["codec"])
+    truth_path = base + ".truth.mid"
+
+    if not (os.path.exists(video_path) and os.path.exists(truth_path)):
+        if midi_path:
+            with open(midi_path, 'rb') as src, open(truth_path, 'wb') as dst:
+                dst.write(src.read())
+        else:
+            write_notes_midi(generate_notes(case), case["fps"], truth_path)
+        t0 = time.perf_counter()
+        render_video(case, truth_path, video_path)
+        logging.info(f"Rendered {video_path} in {time.perf_counter() - t0:.1f} s")
+    return video_path, truth_path
+
+# --- Measurement ---
+
+def peak_rss_mb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return peak / (1048576.0 if sys.platform == "darwin" else 1024.0)
+
+def run_case(case, video_path, truth_path, output_dir, segments=1, onset_tolerance=0.1, backend="opencv",
+             decoder_threads=0, luma=False, frame_stride=1, calibration_samples=1):
+    """Calibrates and converts one video. Runs in a fresh process so the peak RSS is its own."""
+    result = {"case": case, "backend": backend, "decoder_threads": decoder_threads, "luma": luma,
+              "frame_stride": frame_stride, "calibration_samples": calibration_samples, "segments": segments}
+    processor = VideoProcessor(video_path, backend=backend, decoder_threads=decoder_threads)
+    processor.start_key = case["start_key"]
+    processor.end_key = case["start_key"] + case["keys"] - 1
+    processor.bpm = BENCH_BPM
+    processor.use_luma = luma
+    processor.frame_stride = frame_stride
+    processor.calibration_samples = calibration_samples
+
+    # 1. Calibration (a single start frame is decoded outside the timing, as before)
+    if calibration_samples <= 1:
+        processor.get_frame(processor.start_frame)
+    t0 = time.perf_counter()
+    result["keys_detected"] = processor.calibrate()
+    result["analyze_ms"] = (time.perf_counter() - t0) * 1000.0
+    result["keys_expected"] = case["keys"]
+
+    # 2. Conversion
+    output_path = os.path.join(output_dir, os.path.splitext(os.path.basename(video_path))[0] + f".{backend}.mid")
+    profiler = StageProfiler()
+    t0 = time.perf_counter()
+    processor.convert_to_midi(output_path, segments=segments, profiler=profiler)
+    elapsed = time.perf_counter() - t0
+    frames = processor.end_frame - processor.start_frame
+    result["frames"] = frames
+    result["elapsed_s"] = elapsed
+    result["fps"] = frames / elapsed if elapsed > 0 else 0.0
+    result["peak_rss_mb"] = peak_rss_mb()
+    result["stages"] = {name: s["total_s"] for name, s in profiler.to_dict()["stages"].items()}
+
+    # 3. Accuracy against the ground truth
+    result.update(match_notes(read_midi_notes(truth_path), read_midi_notes(output_path), onset_tolerance))
+    return result
+
+def environment_info():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "commit": commit,
+        "python": platform.python_version(),
+        "opencv": cv2.__version__,
+        "numpy": np.__version__,
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+    }
+
+# --- Comparison ---
+
+def compare_results(old, new, fps_tolerance=0.10, accuracy_tolerance=0.01, rss_tolerance=0.20):
+    """Returns (report lines, number of regressions) for the cases present in both result sets."""
+    old_cases = {result_label(r, old.get("settings")): r for r in old["cases"]}
+    lines = [f"{'case':<36}{'fps':>18}{'precision':>20}{'recall':>20}{'peak RSS MB':>20}"]
+    regressions = 0
+    for r in new["cases"]:
+        name = result_label(r, new.get("settings"))
+        o = old_cases.get(name)
+        if o is None:
+            lines.append(f"{name:<36}  (new case)")
+            continue
+        flags = []
+        if r["fps"] < o["fps"] * (1 - fps_tolerance):
+            flags.append("fps")
+        for metric in ("precision", "recall"):
+            if r[metric] < o[metric] - accuracy_tolerance:
+                flags.append(metric)
+        if o.get("peak_rss_mb") and r.get("peak_rss_mb") and r["peak_rss_mb"] > o["peak_rss_mb"] * (1 + rss_tolerance):
+            flags.append("rss")
+        regressions += bool(flags)
+
+        def cell(a, b, fmt):
+            return f"{format(a, fmt)} -> {format(b, fmt)}" if a is not None and b is not None else "n/a"
+        lines.append(
+            f"{name:<36}{cell(o['fps'], r['fps'], '.1f'):>18}{cell(o['precision'], r['precision'], '.3f'):>20}"
+            f"{cell(o['recall'], r['recall'], '.3f'):>20}{cell(o.get('peak_rss_mb'), r.get('peak_rss_mb'), '.0f'):>20}"
+            + (f"  REGRESSION: {', '.join(flags)}" if flags else "")
+        )
+    return lines, regressions
+
+def result_label(r, settings=None):
+    """Case name plus the settings that change its numbers, so --compare only pairs like runs (defaults omitted).
+
+    settings (the "settings" of the results file) fills in what older files did not record per case.
+    """
+    def get(name, default):
+        return r.get(name, (settings or {}).get(name, default))
+    parts = [r.get('backend', 'opencv')]
+    if get('luma', False):
+        parts.append("luma")
+    if get('frame_stride', 1) > 1:
+        parts.append(f"stride {get('frame_stride', 1)}")
+    if get('calibration_samples', 1) > 1:
+        parts.append(f"{get('calibration_samples', 1)} samples")
+    if get('segments', 1) > 1:
+        parts.append(f"{get('segments', 1)} segments")
+    return f"{r['case']['name']} [{', '.join(parts)}]"
+
+def format_result(r):
+    rss = f"{r['peak_rss_mb']:.0f} MB" if r.get("peak_rss_mb") is not None else "n/a"
+    return (f"{result_label(r)}: {r['fps']:.1f} fps, peak RSS {rss}, keys {r['keys_detected']}/{r['keys_expected']} "
+            f"({r['analyze_ms']:.1f} ms), precision {r['precision']:.3f}, recall {r['recall']:.3f} "
+            f"({r['matched']}/{r['notes_expected']} notes, {r['notes_detected']} detected)")
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Benchmark conversion speed and accuracy on synthetic videos.")
+    parser.add_argument("-o", "--output", default="benchmark_results.json", help="Results file (.json)")
+    parser.add_argument("--compare", help="Previous results file to compare against (exit code 1 on regression)")
+    parser.add_argument("--case", action="append", help=f"Suite case(s) to run: {', '.join(c['name'] for c in SUITE)}")
+    parser.add_argument("--work-dir", default=os.path.join(tempfile.gettempdir(), "vtm_benchmark"),
+                        help="Where rendered videos are cached and converted MIDI files are written")
+    parser.add_argument("--midi", help="Render this MIDI file instead of random notes")
+    parser.add_argument("--segments", type=int, default=1, help="Passed to convert_to_midi")
+    parser.add_argument("--backend", action="append", choices=list(BACKENDS),
+                        help="Decoder backend(s) to compare on every case (default: opencv)")
+    parser.add_argument("--decoder-threads", type=int, default=0, help="Decoder threads (default: backend default)")
+    parser.add_argument("--luma", action="store_true", help="Measure the luma plane only (VideoProcessor.use_luma)")
+    parser.add_argument("--stride", type=int, default=1, help="Detection frame stride (VideoProcessor.frame_stride)")
+    parser.add_argument("--calibration-samples", type=int, default=1, help="Frames sampled by calibrate()")
+    parser.add_argument("--onset-tolerance", type=float, default=0.1, help="Seconds (default: 0.1)")
+    parser.add_argument("--fps-tolerance", type=float, default=0.10, help="Allowed fps drop when comparing (default: 0.10)")
+    parser.add_argument("-v", "--verbose", action="store_true")
+    # A custom case instead of the suite
+    for key in ("width", "height", "fps", "particles", "keys", "start_key", "seed"):
+        parser.add_argument(f"--{key.replace('_', '-')}", type=int)
+    parser.add_argument("--codec", help="FourCC, e.g. MJPG, mp4v, XVID")
+    parser.add_argument("--duration", type=float, help="Seconds")
+    parser.add_argument("--notes-per-second", type=float)
+    return parser
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    logging.basicConfig(
+        level=logging.DEBUG if args.verbose else logging.INFO,
+        format='%(asctime)s - %(levelname)s - %(message)s'
+    )
+
+    custom = {k: getattr(args, k) for k in CASE_DEFAULTS if getattr(args, k) is not None}
+    if custom:
+        cases = [make_case(custom)]
+    else:
+        selected = [c for c in SUITE if not args.case or c["name"] in args.case]
+        unknown = set(args.case or []) - {c["name"] for c in SUITE}
+        if unknown:
+            logging.error(f"Unknown case(s): {', '.join(sorted(unknown))}")
+            return 2
+        cases = [make_case(c) for c in selected]
+
+    os.makedirs(args.work_dir, exist_ok=True)
+    results = environment_info()
+    backends = args.backend or ["opencv"]
+    results["settings"] = {"segments": args.segments, "onset_tolerance": args.onset_tolerance,
+                           "backends": backends, "decoder_threads": args.decoder_threads,
+                           "luma": args.luma, "frame_stride": args.stride,
+                           "calibration_samples": args.calibration_samples}
+    results["cases"] = []
+
+    for case in cases:
+        video_path, truth_path = prepare_case(case, args.work_dir, args.midi)
+        for backend in backends:
+            # Fresh interpreter per run: the peak RSS must not include the previous ones
+            with ProcessPoolExecutor(max_workers=1, mp_context=get_context("spawn")) as pool:
+                result = pool.submit(run_case, case, video_path, truth_path, args.work_dir, args.segments,
+                                     args.onset_tolerance, backend, args.decoder_threads,
+                                     args.luma, args.stride, args.calibration_samples).result()
+            logging.info(format_result(result))
+            results["cases"].append(result)
+
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(results, f, indent=4)
+    logging.info(f"Results saved to {args.output}")
+
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as f:
+            old = json.load(f)
+        lines, regressions = compare_results(old, results, fps_tolerance=args.fps_tolerance)
+        logging.info(f"Comparison with {args.compare} ({old.get('commit')}):\n" + "\n".join(lines))
+        if regressions:
+            logging.warning(f"{regressions} case(s) regressed")
+            return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,123 @@
+﻿import hashlib
+import json
+import os
+import struct
+import numpy as np
+
+MAGIC = b"VTMIDX01"
+ALIGN = 64
+FINGERPRINT_CHUNK = 1 << 20
+
+def video_fingerprint(video_path):
+    """Quick content hash of a video: its size plus the first and last MiB."""
+    size = os.path.getsize(video_path)
+    h = hashlib.sha1(str(size).encode())
+    with open(video_path, 'rb') as f:
+        h.update(f.read(FINGERPRINT_CHUNK))
+        if size > FINGERPRINT_CHUNK:
+            f.seek(max(FINGERPRINT_CHUNK, size - FINGERPRINT_CHUNK))
+            h.update(f.read(FINGERPRINT_CHUNK))
+    return h.hexdigest()
+
+def _aligned(offset):
+    return (offset + ALIGN - 1) // ALIGN * ALIGN
+
+class BrightnessIndex:
+    """Per-frame detection measurements of a video in a memory-mapped ".vtm-index" sidecar.
+
+    Each frame has one row: the column sums of the detection strip (automatic mode)
+    or the mean of every manual box. Rows are written while a conversion decodes the
+    video; once every frame of a range is present, thresholding and debounce can be
+    replayed from the file without decoding anything. The header key records the
+    video fingerprint and the detection geometry; a different key rebuilds the file.
+
+    File layout: MAGIC, uint32 header length, JSON header, then (64-byte aligned) one
+    validity byte per frame and the (frame_count, columns) row array.
+    """
+    def __init__(self, path, header, valid, data):
+        self.path = path
+        self.header = header
+        self.key = header["key"]
+        self.frame_count = header["frame_count"]
+        self.divisor = header["divisor"]
+        self.valid = valid
+        self.data = data
+
+    @staticmethod
+    def path_for(video_path):
+        return video_path + ".vtm-index"
+
+    @staticmethod
+    def _read_header(f):
+        if f.read(len(MAGIC)) != MAGIC:
+            return None
+        (length,) = struct.unpack("<I", f.read(4))
+        return json.loads(f.read(length).decode('utf-8')), length
+
+    @staticmethod
+    def _offsets(header_length, frame_count):
+        valid_offset = _aligned(len(MAGIC) + 4 + header_length)
+        return valid_offset, _aligned(valid_offset + frame_count)
+
+    @classmethod
+    def open(cls, path, key, frame_count, columns, dtype, divisor=1, create=True):
+        """Opens the index at path if it was built for key, otherwise (re)creates it (or returns None)."""
+        dtype = np.dtype(dtype)
+        header = {
+            "version": 1, "key": key, "frame_count": frame_count, "columns": columns,
+            "dtype": dtype.str, "divisor": divisor,
+        }
+        encoded = json.dumps(header).encode('utf-8')
+        header = json.loads(encoded) # Same types as a header read back from the file
+
+        existing = None
+        if os.path.exists(path):
+            try:
+                with open(path, 'rb') as f:
+                    existing = cls._read_header(f)
+            except (OSError, ValueError, struct.error):
+                existing = None
+
+        if existing is not None and existing[0] == header:
+            header_length = existing[1]
+        elif create:
+            header_length = len(encoded)
+            _, data_offset = cls._offsets(header_length, frame_count)
+            with open(path, 'wb') as f:
+                f.write(MAGIC + struct.pack("<I", header_length) + encoded)
+                f.truncate(data_offset + frame_count * columns * dtype.itemsize) # Zero filled: no frame valid yet
+        else:
+            return None
+
+        valid_offset, data_offset = cls._offsets(header_length, frame_count)
+        valid = np.memmap(path, dtype=np.uint8, mode='r+', offset=valid_offset, shape=(frame_count,))
+        data = np.memmap(path, dtype=dtype, mode='r+', offset=data_offset, shape=(frame_count, columns))
+        return cls(path, header, valid, data)
+
+    def covers(self, start_frame, end_frame):
+        """True if every frame of [start_frame, end_frame) is stored."""
+        if start_frame < 0 or end_frame > self.frame_count:
+            return False
+        return bool(np.all(self.valid[start_frame:end_frame]))
+
+    def write(self, frame_idx, row):
+        if 0 <= frame_idx < self.frame_count:
+            self.data[frame_idx] = row
+            self.valid[frame_idx] = 1
+
+    def read(self, start_frame, end_frame, columns=None):
+        """Rows of [start_frame, end_frame) as float64 measurements (optionally only some columns)."""
+        rows = self.data[start_frame:end_frame]
+        if columns is not None:
+            rows = rows[:, columns]
+        return rows.astype(np.float64) / self.divisor if self.divisor != 1 else rows.astype(np.float64)
+
+    def flush(self):
+        if self.data is not None:
+            self.data.flush()
+            self.valid.flush()
+
+    def close(self):
+        self.flush()
+        # Dropping the memmaps unmaps the file (needed before it can be rebuilt on Windows)
+        self.valid = self.data = None
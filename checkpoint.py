@@ -0,0 +1,77 @@
+﻿import json
+import logging
+import os
+import numpy as np
+
+class ConversionCheckpoint:
+    """State of a running conversion saved in a ".vtm-checkpoint" file next to the output.
+
+    Written every few seconds of video: the next frame to evaluate, the key engine
+    arrays (baselines, confirmed/pending/last reported states), the notes found so
+    far (held ones are the open notes) and the position of the streamed MIDI file.
+    A conversion started again with the same key (video fingerprint, settings and
+    frame range) continues from there and produces the same output as an
+    uninterrupted run. The file is replaced atomically, so a run killed while
+    saving leaves the previous checkpoint.
+    """
+    def __init__(self, path, key):
+        self.path = path
+        self.key = json.loads(json.dumps(key)) # Same types as a key read back from the file
+
+    @staticmethod
+    def path_for(output_path):
+        return output_path + ".vtm-checkpoint"
+
+    def save(self, next_frame, engine, notes, writer=None, counters=(0, 0)):
+        data = {
+            'key': np.array(json.dumps(self.key)),
+            'next_frame': np.int64(next_frame),
+            'counters': np.array(counters, dtype=np.int64), # Processed frames, events
+            'base': engine.base, 'confirmed': engine.confirmed,
+            'consecutive': engine.consecutive, 'last': engine.last,
+            'notes': notes.notes,
+        }
+        if writer is not None:
+            state = writer.state()
+            data['midi'] = np.array([state['track_length'], state['running_status'] or -1,
+                                     state['last_event_frame'], state['events']], dtype=np.int64)
+        tmp = self.path + ".tmp"
+        with open(tmp, 'wb') as f:
+            np.savez(f, **data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+
+    def load(self):
+        """The saved state as a dict of arrays, or None if there is no usable checkpoint for this key."""
+        if not os.path.exists(self.path):
+            return None
+        try:
+            with np.load(self.path, allow_pickle=False) as f:
+                state = {name: f[name] for name in f.files}
+            if json.loads(str(state['key'])) != self.key:
+                logging.info(f"Ignoring checkpoint {self.path}: made with other settings")
+                return None
+        except (OSError, ValueError, KeyError) as e:
+            logging.warning(f"Ignoring unreadable checkpoint {self.path}: {e}")
+            return None
+        if 'midi' in state:
+            track_length, running_status, last_event_frame, events = state.pop('midi').tolist()
+            state['writer'] = {'track_length': track_length, 'running_status': running_status if running_status >= 0 else None,
+                               'last_event_frame': last_event_frame, 'events': events}
+        return state
+
+    def restore(self, state, engine, notes):
+        """Puts the saved key states and notes back into engine and notes; returns the next frame."""
+        engine.base[:] = state['base']
+        engine.confirmed[:] = state['confirmed']
+        engine.consecutive[:] = state['consecutive']
+        engine.last[:] = state['last']
+        notes.set_notes(state['notes'])
+        return int(state['next_frame'])
+
+    def remove(self):
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,274 @@
+﻿"""Headless batch converter.
+
+Converts one video or every video in a directory to MIDI using a calibration
+saved from the GUI, without importing Tk.
+
+    python cli.py -c calibration.json video.mp4
+    python -m cli -c calibration.json videos/ -o midi/ --jobs 8
+    python cli.py -c calibration.json recital.mp4 --segments 32
+    python cli.py -c calibration.json video.mp4 --profile
+    python cli.py -c calibration.json video.mp4 --save-notes
+    python cli.py -c calibration.json videos/ --save-notes npz
+    python cli.py -c calibration.json long.mp4 --stream --resume
+    python cli.py -c other_bpm.json video.notes.json --overwrite
+"""
+import argparse
+import logging
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from core import VideoProcessor
+from profiler import StageProfiler
+from note_events import NoteEvents, DEFAULT_VELOCITY_CURVE
+from decoders import BACKENDS
+from checkpoint import ConversionCheckpoint
+
+VIDEO_EXTENSIONS = (".mp4", ".avi", ".mov", ".mkv")
+NOTES_SUFFIX = ".notes" # Notes saved by --save-notes (<name>.notes.<format>)
+NOTES_FORMATS = ("json", "npz", "csv")
+NOTES_INPUTS = (".notes.json", ".notes.npz") # Saved notes exported again without decoding
+
+def collect_videos(inputs):
+    """Expands the input paths (files or directories) into a sorted list of video files."""
+    videos = []
+    for path in inputs:
+        if os.path.isdir(path):
+            for name in sorted(os.listdir(path)):
+                if name.lower().endswith(VIDEO_EXTENSIONS + NOTES_INPUTS):
+                    videos.append(os.path.join(path, name))
+        elif os.path.isfile(path):
+            videos.append(path)
+        else:
+            logging.error(f"Input not found: {path}")
+    return videos
+
+def output_path_for(video_path, output_dir):
+    name = os.path.basename(video_path)
+    if name.lower().endswith(NOTES_INPUTS):
+        base = name[:name.lower().rindex(NOTES_SUFFIX)] + ".mid"
+    else:
+        base = os.path.splitext(name)[0] + ".mid"
+    return os.path.join(output_dir or os.path.dirname(os.path.abspath(video_path)), base)
+
+def profile_path_for(output_path):
+    return os.path.splitext(output_path)[0] + ".profile.json"
+
+def notes_path_for(output_path, notes_format="json"):
+    return os.path.splitext(output_path)[0] + f"{NOTES_SUFFIX}.{notes_format}"
+
+def export_notes(notes_path, output_path, calibration):
+    """Writes a MIDI file from saved notes with the MIDI settings (BPM, quantization, velocity) of calibration."""
+    notes = NoteEvents.load(notes_path)
+    velocity_curve = calibration.get("velocity_curve", DEFAULT_VELOCITY_CURVE) if calibration.get("use_velocity") else None
+    mid = notes.to_midi(calibration.get("bpm", 120), calibration.get("use_quantization", False),
+                        calibration.get("quantization_value", "1/16"), velocity_curve=velocity_curve)
+    mid.save(output_path)
+    return len(notes)
+
+def convert_video(video_path, output_path, calibration, start_frame=0, end_frame=None, segments=1, profile=False,
+                  use_index=False, save_notes=None, backend="opencv", decoder_threads=0, frame_stride=1,
+                  stream_midi=False, resumable=False, checkpoint_seconds=5.0):
+    """Converts a single video. Runs in the worker processes, so it must stay picklable.
+
+    save_notes is a NOTES_FORMATS entry (or None). Returns (num_keys, frames, elapsed, profile_table);
+    profile_table is None unless profile is set.
+    """
+    processor = VideoProcessor(video_path, backend=backend, decoder_threads=decoder_threads)
+    if processor.frame_count <= 0:
+        raise ValueError(f"Cannot read video: {video_path}")
+    processor.set_calibration(calibration)
+    processor.use_index = use_index
+    processor.frame_stride = frame_stride
+    processor.stream_midi = stream_midi
+    processor.resumable = resumable
+    processor.checkpoint_seconds = checkpoint_seconds
+    processor.start_frame = max(0, min(start_frame, processor.frame_count - 1))
+    processor.end_frame = processor.frame_count if end_frame is None else min(end_frame, processor.frame_count)
+
+    # Recalibrate before conversion (same as the GUI)
+    num_keys = processor.calibrate()
+
+    profiler = StageProfiler() if profile else None
+    t0 = time.perf_counter()
+    processor.convert_to_midi(output_path, segments=segments, profiler=profiler)
+    elapsed = time.perf_counter() - t0
+    frames = processor.end_frame - processor.start_frame
+    if save_notes:
+        processor.note_events.save(notes_path_for(output_path, save_notes))
+
+    table = None
+    if profiler is not None:
+        profiler.save_json(profile_path_for(output_path))
+        table = profiler.summary_table()
+    return num_keys, frames, elapsed, table
+
+def parse_velocity_curve(text):
+    """"30:40,150:127" -> [[30.0, 40.0], [150.0, 127.0]] (brightness delta:velocity points)."""
+    try:
+        curve = [[float(v) for v in point.split(":")] for point in text.split(",")]
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid velocity curve: {text}")
+    if not curve or any(len(point) != 2 for point in curve):
+        raise argparse.ArgumentTypeError(f"invalid velocity curve: {text} (expected delta:velocity,...)")
+    return curve
+
+def _init_worker():
+    # One process per core already, avoid oversubscribing with OpenCV's own thread pool
+    import cv2
+    cv2.setNumThreads(1)
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Convert piano videos to MIDI without the GUI.")
+    parser.add_argument("inputs", nargs="+", help="Video files and/or directories containing videos")
+    parser.add_argument("-c", "--calibration", required=True, help="Calibration file saved from the GUI (.json)")
+    parser.add_argument("-o", "--output-dir", help="Output directory (default: next to each video)")
+    parser.add_argument("-j", "--jobs", type=int, default=0, help="Parallel processes (default: number of cores)")
+    parser.add_argument("-s", "--segments", type=int, default=1,
+                        help="Split each video into N segments converted in parallel processes (for long videos)")
+    parser.add_argument("-b", "--backend", choices=list(BACKENDS), default="opencv",
+                        help="Video decoder: opencv (default), pyav (needs PyAV) or ffmpeg (needs ffmpeg on PATH, "
+                             "decodes only the detection strip)")
+    parser.add_argument("--decoder-threads", type=int, default=0, help="Decoder threads (default: backend default)")
+    parser.add_argument("--luma", action="store_true",
+                        help="Measure the luma plane only (faster, ignored when the calibration uses the color filter)")
+    parser.add_argument("--calibration-samples", type=int,
+                        help="Calibrate on the median of N frames spread over the video instead of the start frame "
+                             "(overrides the calibration file)")
+    parser.add_argument("--baseline-rate", type=float,
+                        help="Let key baselines follow lighting changes while released (EMA weight per frame, "
+                             "e.g. 0.05; 0 = fixed; overrides the calibration file)")
+    parser.add_argument("--velocity", action="store_true",
+                        help="note_on velocity from the brightness change of each key instead of 64 "
+                             "(overrides the calibration file)")
+    parser.add_argument("--velocity-curve", type=parse_velocity_curve,
+                        help="Brightness delta:velocity points of --velocity, linear in between "
+                             "(default: 30:40,150:127; overrides the calibration file)")
+    parser.add_argument("--stride", type=int, default=1,
+                        help="Run detection on every Nth frame and on the frames in between only around key changes "
+                             "(same result as every frame: N is capped at the shortest debounce, 2 frames by default, "
+                             "and ignored with --baseline-rate)")
+    parser.add_argument("--stream", action="store_true",
+                        help="Write the MIDI file during the conversion, as <name>.partial.mid (a valid partial file at every "
+                             "checkpoint) renamed to <name>.mid when the conversion completes")
+    parser.add_argument("--resume", action="store_true",
+                        help="Save the conversion state at every checkpoint (<output>.vtm-checkpoint) and, when started "
+                             "again with the same settings, continue from the last one")
+    parser.add_argument("--checkpoint-seconds", type=float, default=5.0,
+                        help="Video time between two checkpoints of --stream/--resume (default: 5)")
+    parser.add_argument("--start-frame", type=int, default=0)
+    parser.add_argument("--end-frame", type=int, default=None)
+    parser.add_argument("--profile", action="store_true",
+                        help="Time each conversion stage, write <output>.profile.json and print a summary")
+    parser.add_argument("--index", action="store_true",
+                        help="Keep per-frame measurements in <video>.vtm-index; later runs with other thresholds skip decoding")
+    parser.add_argument("--save-notes", nargs="?", const="json", choices=NOTES_FORMATS,
+                        help=f"Also save the detected notes as <output>{NOTES_SUFFIX}.json (or .npz/.csv); pass a "
+                             ".json/.npz file as input to export it again with other MIDI settings")
+    parser.add_argument("--overwrite", action="store_true", help="Convert again even if the .mid already exists")
+    parser.add_argument("-v", "--verbose", action="store_true")
+    return parser
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    logging.basicConfig(
+        level=logging.DEBUG if args.verbose else logging.INFO,
+        format='%(asctime)s - %(levelname)s - %(message)s'
+    )
+
+    # Validate the calibration once in the parent process
+    try:
+        calibration = VideoProcessor.read_calibration(args.calibration)
+    except (OSError, ValueError) as e:
+        logging.error(f"Cannot read calibration {args.calibration}: {e}")
+        return 2
+    if args.luma:
+        calibration["use_luma"] = True
+    if args.calibration_samples is not None:
+        calibration["calibration_samples"] = args.calibration_samples
+    if args.baseline_rate is not None:
+        calibration["baseline_rate"] = args.baseline_rate
+    if args.velocity:
+        calibration["use_velocity"] = True
+    if args.velocity_curve is not None:
+        calibration["velocity_curve"] = args.velocity_curve
+
+    if args.output_dir:
+        os.makedirs(args.output_dir, exist_ok=True)
+
+    jobs = []
+    for video in collect_videos(args.inputs):
+        out = output_path_for(video, args.output_dir)
+        interrupted = args.resume and os.path.exists(ConversionCheckpoint.path_for(out))
+        if os.path.exists(out) and not (args.overwrite or interrupted):
+            logging.info(f"Skipping {video} ({out} already exists)")
+            continue
+        jobs.append((video, out))
+
+    # Saved notes only need the MIDI export stage: done here, no worker processes
+    failed = 0
+    exports = [(path, out) for path, out in jobs if path.lower().endswith(NOTES_INPUTS)]
+    jobs = [(path, out) for path, out in jobs if not path.lower().endswith(NOTES_INPUTS)]
+    for notes_path, out in exports:
+        try:
+            count = export_notes(notes_path, out, calibration)
+            logging.info(f"{os.path.basename(notes_path)} -> {out} ({count} notes)")
+        except Exception as e:
+            failed += 1
+            logging.error(f"Export failed for {notes_path}: {e}", exc_info=args.verbose)
+
+    if not jobs:
+        if not exports:
+            logging.warning("No videos to convert")
+        return 1 if failed else 0
+
+    if args.segments > 1:
+        # The cores are already used by the segments of each video
+        workers = args.jobs if args.jobs > 0 else 1
+    else:
+        workers = args.jobs if args.jobs > 0 else (os.cpu_count() or 1)
+    workers = min(workers, len(jobs))
+    logging.info(f"Converting {len(jobs)} video(s) with {workers} process(es)")
+
+    if workers == 1:
+        for video, out in jobs:
+            try:
+                result = convert_video(video, out, calibration, args.start_frame, args.end_frame, args.segments,
+                                       args.profile, args.index, args.save_notes, args.backend,
+                                       args.decoder_threads, args.stride, args.stream,
+                                       args.resume, args.checkpoint_seconds)
+                _log_result(video, out, result)
+            except Exception as e:
+                failed += 1
+                logging.error(f"Conversion failed for {video}: {e}", exc_info=args.verbose)
+    else:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker) as pool:
+            futures = {
+                pool.submit(convert_video, video, out, calibration, args.start_frame, args.end_frame, args.segments,
+                            args.profile, args.index, args.save_notes, args.backend,
+                            args.decoder_threads, args.stride, args.stream,
+                            args.resume, args.checkpoint_seconds): (video, out)
+                for video, out in jobs
+            }
+            for future in as_completed(futures):
+                video, out = futures[future]
+                try:
+                    _log_result(video, out, future.result())
+                except Exception as e:
+                    failed += 1
+                    logging.error(f"Conversion failed for {video}: {e}", exc_info=args.verbose)
+
+    logging.info(f"Done: {len(jobs) + len(exports) - failed} converted, {failed} failed")
+    return 1 if failed else 0
+
+def _log_result(video, out, result):
+    num_keys, frames, elapsed, table = result
+    fps = frames / elapsed if elapsed > 0 else 0.0
+    logging.info(f"{os.path.basename(video)} -> {out} ({num_keys} keys, {frames} frames, {fps:.1f} fps)")
+    if table:
+        logging.info(f"Stage profile of {os.path.basename(video)} ({profile_path_for(out)}):\n{table}")
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,18 +1,180 @@
 ﻿import cv2
 import numpy as np
 import threading
+import logging
 import time
-from mido import Message, MidiFile, MidiTrack
 import os
+import json
+from concurrent.futures import ProcessPoolExecutor
+from video_io import FrameSource, FrameCache
+from decoders import open_decoder, open_sampling_decoder
+from filters import FilterPlan
+from pipeline import FramePipeline
+from profiler import NULL_PROFILER
+from brightness_index import BrightnessIndex, video_fingerprint
+from note_events import NoteEvents, DEFAULT_VELOCITY_CURVE, velocities
+from midi_writer import MidiStreamWriter
+from checkpoint import ConversionCheckpoint
+
+# Settings stored in a calibration file (everything except the video-specific frame range)
+CALIBRATION_FIELDS = [
+    "keyboard_y", "detection_height", "threshold", "start_key", "end_key",
+    "off_threshold", "attack_frames", "release_frames", "key_type_settings", "key_settings",
+    "white_threshold_factor", "black_threshold_factor",
+    "bpm", "use_quantization", "quantization_value", "use_velocity", "velocity_curve",
+    "use_manual_mode", "manual_keys", "show_note_names", "use_luma", "calibration_samples", "baseline_rate",
+    "use_color_filter", "hsv_min", "hsv_max", "filter_iterations", "dilate_iterations",
+    "show_binary_mask", "contrast", "brightness", "gamma", "blur_size", "invert_mask",
+    "edge_detection", "use_contour_filling", "contour_color", "min_contour_area",
+    "use_intelligent_filter", "min_aspect_ratio", "contour_context",
+]
+
+def to_luma(image):
+    """Luma (Y) plane of a BGR image; gray images are returned unchanged."""
+    if image.ndim == 2:
+        return image
+    return cv2.cvtColor(np.ascontiguousarray(image), cv2.COLOR_BGR2GRAY)
+
+def find_runs(mask):
+    """(starts, ends) of the runs of True in a 1-D boolean array, ends exclusive."""
+    edges = np.flatnonzero(np.diff(np.concatenate(([False], mask, [False])).astype(np.int8)))
+    return edges[0::2], edges[1::2]
+
+def luma_column_means(gray):
+    """Per-column mean of a gray strip, accumulated in integers (no float temporaries)."""
+    sums = cv2.reduce(np.ascontiguousarray(gray), 0, cv2.REDUCE_SUM, dtype=cv2.CV_32S)
+    return sums[0] / gray.shape[0]
+
+class KeyStateEngine:
+    """Array-backed press detection and debounce state for all keys at once.
+
+    threshold/debounce_limit apply to presses, off_threshold/release_limit to releases
+    (default: the same values). Each may be a scalar or one value per key: a key
+    reading between the two thresholds keeps its state (hysteresis), and a change
+    is confirmed after debounce_limit (press) or release_limit (release) frames.
+    """
+    def __init__(self, base_brightness, threshold, debounce_limit=2, baseline_rate=0.0,
+                 off_threshold=None, release_limit=None):
+        self.base = np.array(base_brightness, dtype=np.float64)
+        num_keys = len(self.base)
+        self.threshold = np.broadcast_to(np.asarray(threshold, dtype=np.float64), (num_keys,))
+        self.off_threshold = self.threshold if off_threshold is None else \
+            np.broadcast_to(np.asarray(off_threshold, dtype=np.float64), (num_keys,))
+        # Minimum number of frames to confirm a press / release
+        self.debounce_limit = np.broadcast_to(np.asarray(debounce_limit, dtype=np.int32), (num_keys,))
+        self.release_limit = self.debounce_limit if release_limit is None else \
+            np.broadcast_to(np.asarray(release_limit, dtype=np.int32), (num_keys,))
+        self.baseline_rate = baseline_rate # EMA weight of each released frame in the baseline (0 = fixed)
+
+        self.confirmed = np.zeros(num_keys, dtype=bool)
+        self.consecutive = np.zeros(num_keys, dtype=np.int32)
+        self.last = np.zeros(num_keys, dtype=bool)
+
+    def pressed(self, brightness):
+        """Instant (not debounced) state of every key: pressed keys are held until they fall below off_threshold."""
+        delta = np.abs(brightness - self.base)
+        return np.where(self.confirmed, delta > self.off_threshold, delta > self.threshold)
+
+    def is_settled(self, brightness):
+        """True if no change is pending and every key reads its confirmed state in brightness.
+
+        Frames between two settled frames can only hold state changes shorter than
+        the gap, so with gaps of at most the shortest debounce limit they change nothing.
+        A tracking baseline (baseline_rate) needs every frame, so it never settles.
+        """
+        if self.baseline_rate > 0:
+            return False
+        return not self.consecutive.any() and np.array_equal(self.pressed(brightness), self.confirmed)
+
+    def update(self, brightness):
+        """Evaluates one frame and returns the indices (ascending) of keys whose confirmed state changed."""
+        # Instant detection
+        pressed_now = self.pressed(brightness)
+
+        # Baseline tracking (lighting drift): only keys confirmed released that still read released
+        if self.baseline_rate > 0:
+            idle = ~(self.confirmed | pressed_now)
+            self.base[idle] += self.baseline_rate * (brightness[idle] - self.base[idle])
+
+        # Debounce Logic: State change must last at least debounce_limit (press) or
+        # release_limit (release) frames, the counter is reset if the state returns to the confirmed one
+        differs = pressed_now != self.confirmed
+        self.consecutive += 1
+        self.consecutive[~differs] = 0
+
+        limit = np.where(self.confirmed, self.release_limit, self.debounce_limit)
+        changed = np.flatnonzero(self.consecutive >= limit)
+        if changed.size == 0:
+            return changed
+
+        # State change CONFIRMED
+        self.confirmed[changed] = pressed_now[changed]
+        self.consecutive[changed] = 0
+
+        # Report only keys whose state changed since the last event sent
+        changed = changed[self.confirmed[changed] != self.last[changed]]
+        self.last[changed] = self.confirmed[changed]
+        return changed
+
+class KeySampler:
+    """Measures the brightness of every key from the detection region of a frame.
+
+    The region is the frame cropped to VideoProcessor.get_detection_roi(), so the key
+    coordinates are translated once here instead of on every frame.
+    """
+    def __init__(self, processor, roi):
+        x0, y0, _, _ = roi
+        self.manual = processor.use_manual_mode
+        self.luma = processor.measures_luma()
+        self.base = np.array(processor.base_brightness, dtype=np.float64)
+        if self.manual:
+            # Box slices relative to the region (None for boxes fully outside the frame)
+            self.boxes = []
+            for key_info in processor.key_positions:
+                x, y, w, h = key_info['x'], key_info['y'], key_info['w'], key_info['h']
+                y_s, y_e = max(0, y), min(processor.height, y + h)
+                x_s, x_e = max(0, x), min(processor.width, x + w)
+                if y_e > y_s and x_e > x_s:
+                    self.boxes.append((slice(y_s - y0, y_e - y0), slice(x_s - x0, x_e - x0)))
+                else:
+                    self.boxes.append(None)
+        else:
+            _, y_start, y_end = processor.get_detection_rows()
+            self.rows = slice(y_start - y0, y_end - y0)
+            # Only the columns under the detected keys are reduced on each frame
+            self.columns = np.array([k['pos'] - x0 for k in processor.key_positions], dtype=np.intp)
+
+    def __call__(self, region):
+        if self.manual:
+            if self.luma:
+                region = to_luma(region)
+            brightness = np.empty(len(self.boxes))
+            for i, box in enumerate(self.boxes):
+                # Boxes outside the frame keep their base brightness (never pressed)
+                brightness[i] = np.mean(region[box[0], box[1]]) if box else self.base[i]
+            return brightness
+        if self.luma:
+            # Only the key columns are converted (a no-op when the decoder already delivers gray)
+            return luma_column_means(to_luma(region[self.rows].take(self.columns, axis=1)))
+        # take() keeps the strip C-contiguous so the reduction matches the full-width one
+        kb_area = region[self.rows, :, :].take(self.columns, axis=1)
+        return np.mean(np.mean(kb_area, axis=2), axis=0)
 
 class VideoProcessor:
-    def __init__(self, video_path):
+    def __init__(self, video_path, backend="opencv", decoder_threads=0):
         self.video_path = video_path
-        self.cap = cv2.VideoCapture(video_path)
-        self.fps = self.cap.get(cv2.CAP_PROP_FPS)
-        self.width = int(self.cap.get(cv2.CAP_PROP_FRAME_WIDTH))
-        self.height = int(self.cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
-        self.frame_count = int(self.cap.get(cv2.CAP_PROP_FRAME_COUNT))
+        # Decoder backend (see decoders.py): "opencv" (default), "pyav" or "ffmpeg"
+        self.backend = backend
+        self.decoder_threads = decoder_threads
+        self.decoder = open_decoder(backend, video_path, threads=decoder_threads)
+        self.fps = self.decoder.fps
+        self.width = self.decoder.width
+        self.height = self.decoder.height
+        self.frame_count = self.decoder.frame_count
+        # All reads go through the frame source so sequential access never seeks
+        self.frame_source = FrameSource(self.decoder)
+        # Decoded frames for interactive use (preview, scrubbing, calibration)
+        self.frame_cache = FrameCache(max_mb=512)
         
         self.start_frame = 0
         self.end_frame = self.frame_count
@@ -21,6 +183,15 @@ class VideoProcessor:
         self.keyboard_y = 0.75 # Fraction of the height
         self.detection_height = 10 # Height in pixels of the detection area
         self.threshold = 30
+        # Hysteresis and debounce: a pressed key is released below off_threshold (None = threshold),
+        # presses/releases are confirmed after attack_frames/release_frames frames
+        self.off_threshold = None
+        self.attack_frames = 2
+        self.release_frames = 2
+        # Overrides of the four values above per key type ("white", "black", "manual") and per
+        # MIDI note (string keys, as in JSON), e.g. {"black": {"threshold": 20}}, {"60": {"attack_frames": 3}}
+        self.key_type_settings = {}
+        self.key_settings = {}
         self.start_key = 21 # MIDI Note
         self.end_key = 108 # 88 keys (A0 - C8)
         self.key_positions = []
@@ -32,15 +203,25 @@ class VideoProcessor:
         self.bpm = 120
         self.use_quantization = False
         self.quantization_value = "1/16"
+        self.use_velocity = False # note_on velocity from the brightness delta (otherwise 64)
+        self.velocity_curve = [list(p) for p in DEFAULT_VELOCITY_CURVE] # (brightness delta, velocity) points
         
         # Separate thresholds for white and black keys
         self.white_threshold_factor = 0.7
         self.black_threshold_factor = 0.3
         
+        # Frames sampled by calibrate() (1 = the start frame only)
+        self.calibration_samples = 1
+        # Baselines follow lighting changes while keys are released (EMA weight per frame, 0 = fixed)
+        self.baseline_rate = 0.0
+        
         # Manual Mode
         self.use_manual_mode = False
         self.manual_keys = [] # List of {'x': x, 'y': y, 'w': w, 'h': h, 'type': 'manual'}
         
+        # Luma fast path: measure the Y plane instead of the mean of B, G and R (color filter off only)
+        self.use_luma = False
+        
         # Color Filtering (HSV)
         self.use_color_filter = False
         self.hsv_min = np.array([0, 0, 200]) # Default white/bright
@@ -61,148 +242,182 @@ class VideoProcessor:
         self.min_contour_area = 20 # Minimum area in pixels to keep a contour
         self.use_intelligent_filter = False # Filter by shape/aspect ratio
         self.min_aspect_ratio = 1.5 # Min H/W for a falling note
+        self.contour_context = 64 # Extra pixels around the strip so contours keep their shape
+        self.filter_plan = None # Compiled on demand from the settings above
+        self.filter_timings = {}
+        
+        # Brightness index (".vtm-index" sidecar next to the video)
+        self.use_index = False # Record per-frame measurements and replay them when possible
+        self.video_hash = None
+        
+        # Detection runs on every Nth frame; the frames in between only when a key may have changed
+        self.frame_stride = 1
+        
+        self.note_events = None # NoteEvents of the last conversion (input of export_midi)
+        self.stream_midi = False # Write the MIDI file during the conversion (see MidiStreamWriter)
+        self.resumable = False # Save the conversion state at every checkpoint and continue from it (see ConversionCheckpoint)
+        self.checkpoint_seconds = 5.0 # Video time between two checkpoints
         
         # Note names for display
         self.show_note_names = False
         self.note_names = ["C", "C#", "D", "D#", "E", "F", "F#", "G", "G#", "A", "A#", "B"]
 
+    def get_calibration(self):
+        """Returns the detection, filter and MIDI settings as a JSON-serializable dict."""
+        data = {}
+        for field in CALIBRATION_FIELDS:
+            value = getattr(self, field)
+            if isinstance(value, np.ndarray):
+                value = value.tolist()
+            elif isinstance(value, tuple):
+                value = list(value)
+            data[field] = value
+        return data
+
+    def set_calibration(self, data):
+        """Applies settings produced by get_calibration. Unknown fields are ignored."""
+        for field in CALIBRATION_FIELDS:
+            if field not in data:
+                continue
+            value = data[field]
+            if field in ("hsv_min", "hsv_max"):
+                value = np.array(value)
+            elif field == "contour_color":
+                value = tuple(int(c) for c in value)
+            elif field == "manual_keys":
+                value = [dict(k) for k in value]
+            elif field == "velocity_curve":
+                value = [[float(d), float(v)] for d, v in value]
+            elif field in ("key_type_settings", "key_settings"):
+                value = {str(k): dict(v) for k, v in value.items()}
+            setattr(self, field, value)
+        # Key positions depend on the settings, force a new calibration
+        self.key_positions = []
+        self.base_brightness = []
+
+    def save_calibration(self, path):
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(self.get_calibration(), f, indent=4)
+
+    @staticmethod
+    def read_calibration(path):
+        with open(path, 'r', encoding='utf-8-sig') as f:
+            data = json.load(f)
+        if not isinstance(data, dict):
+            raise ValueError(f"Invalid calibration file: {path}")
+        return data
+
+    def load_calibration(self, path):
+        self.set_calibration(self.read_calibration(path))
+
     def midi_to_note_name(self, midi_number):
         """Converts MIDI note number to note name (e.g., 60 -> C4)."""
         octave = (midi_number // 12) - 1
         note_idx = midi_number % 12
         return f"{self.note_names[note_idx]}{octave}"
 
+    def compile_filter_plan(self):
+        """Compiles the current filter settings (call after changing them, e.g. from a slider)."""
+        self.filter_plan = FilterPlan(self, timings=self.filter_timings)
+        return self.filter_plan
+
+    def get_filter_plan(self):
+        # Settings can also be changed programmatically (calibration files, CLI): recompile if stale
+        if self.filter_plan is None or self.filter_plan.key != FilterPlan.settings_key(self):
+            self.compile_filter_plan()
+        return self.filter_plan
+
+    def get_filter_timings(self):
+        """Per-stage timing breakdown of the color filter since the video was loaded."""
+        return self.get_filter_plan().timing_report()
+
     def apply_color_filter(self, frame):
         if not self.use_color_filter:
             return frame
-            
-        # 1. Basic image adjustments (Contrast/Brightness)
-        # alpha = contrast, beta = brightness
-        frame_adj = cv2.convertScaleAbs(frame, alpha=self.contrast, beta=self.brightness)
-        
-        # 2. Gamma correction
-        if self.gamma != 1.0:
-            inv_gamma = 1.0 / self.gamma
-            table = np.array([((i / 255.0) ** inv_gamma) * 255 for i in np.arange(0, 256)]).astype("uint8")
-            frame_adj = cv2.LUT(frame_adj, table)
+        return self.get_filter_plan().apply(frame)
+
+    def read_frame(self, frame_idx):
+        """Returns the raw (unfiltered, read-only) frame, using the LRU cache for repeated requests."""
+        frame = self.frame_cache.get(frame_idx)
+        if frame is None:
+            # The frame source only seeks when frame_idx is not the next frame (or a recent one)
+            frame = self.frame_source.read(frame_idx)
+            if frame is not None:
+                self.frame_cache.put(frame_idx, frame)
+        return frame
 
-        # 2b. Edge Detection (optional)
+    def get_filter_margin(self):
+        """Pixels of context the filter needs around a region so the region itself is unaffected by the crop."""
+        margin = 1
+        margin += self.blur_size # Gaussian kernel radius
+        margin += 4 * self.filter_iterations # Opening + closing, each erode and dilate once per iteration
+        margin += self.dilate_iterations
         if self.edge_detection:
-            gray = cv2.cvtColor(frame_adj, cv2.COLOR_BGR2GRAY)
-            edges = cv2.Canny(gray, 50, 150)
-            # Convert back to BGR to allow combined operations if needed, 
-            # or just use it to enhance the frame
-            edges_bgr = cv2.cvtColor(edges, cv2.COLOR_GRAY2BGR)
-            frame_adj = cv2.addWeighted(frame_adj, 0.7, edges_bgr, 0.3, 0)
-        
-        # 3. Gaussian Blur to reduce noise/sparkles
-        if self.blur_size > 0:
-            # Ensure blur_size is odd
-            k_size = self.blur_size * 2 + 1
-            frame_adj = cv2.GaussianBlur(frame_adj, (k_size, k_size), 0)
-            
-        # 4. HSV Filtering
-        hsv = cv2.cvtColor(frame_adj, cv2.COLOR_BGR2HSV)
-        mask = cv2.inRange(hsv, self.hsv_min, self.hsv_max)
-        
-        # 5. Invert mask if requested
-        if self.invert_mask:
-            mask = cv2.bitwise_not(mask)
-        
-        # 6. Morphological operations
-        kernel = np.ones((3, 3), np.uint8)
-        if self.filter_iterations > 0:
-            mask = cv2.morphologyEx(mask, cv2.MORPH_OPEN, kernel, iterations=self.filter_iterations)
-            mask = cv2.morphologyEx(mask, cv2.MORPH_CLOSE, kernel, iterations=self.filter_iterations)
+            margin += 2 # Sobel aperture + non-maximum suppression
+        if self.use_contour_filling:
+            margin += self.contour_context
+        return margin
 
-        # 6b. Extra Dilate to expand thin edges/notes
-        if self.dilate_iterations > 0:
-            mask = cv2.dilate(mask, kernel, iterations=self.dilate_iterations)
+    def apply_color_filter_roi(self, frame, roi):
+        """Runs the filter pipeline only on roi (plus a margin) and returns the filtered roi.
 
-        # 7. Apply mask to keep original colors or show binary
-        if self.use_contour_filling:
-            # Create a black background image
-            filtered = np.zeros_like(frame_adj)
-            # Find contours on the binary mask
-            contours, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-            
-            # Filter contours by minimum area (to remove small particles)
-            filtered_contours = []
-            for cnt in contours:
-                area = cv2.contourArea(cnt)
-                if area < self.min_contour_area:
-                    continue
-                
-                if self.use_intelligent_filter:
-                    # Falling notes are usually vertical rectangles
-                    x, y, w, h = cv2.boundingRect(cnt)
-                    aspect_ratio = float(h) / w
-                    # Check if it's "note-like" (vertical and relatively rectangular)
-                    # Note: particles are often circular or scattered
-                    if aspect_ratio < self.min_aspect_ratio:
-                        continue
-                    # Rectangularity check: area / (w*h) should be high
-                    rect_area = w * h
-                    if rect_area > 0:
-                        rectangularity = area / rect_area
-                        if rectangularity < 0.5: # At least 50% of the bounding box
-                            continue
-                
-                filtered_contours.append(cnt)
-                
-            # Draw filtered contours filled with solid chosen color
-            cv2.drawContours(filtered, filtered_contours, -1, self.contour_color, thickness=-1)
-        elif self.show_binary_mask:
-            # Show the mask itself as a grayscale/BGR image
-            filtered = cv2.cvtColor(mask, cv2.COLOR_GRAY2BGR)
-        else:
-            # Apply mask to keep original colors but black out everything else
-            filtered = cv2.bitwise_and(frame_adj, frame_adj, mask=mask)
-        
-        return filtered
+        Pixel-local stages (adjustments, blur, HSV, morphology) give exactly the same
+        result as filtering the whole frame. Canny hysteresis and contour shape tests
+        only see the margin, so long edges/notes cut by it may be judged differently.
+        """
+        x0, y0, x1, y1 = roi
+        margin = self.get_filter_margin()
+        fx0, fy0 = max(0, x0 - margin), max(0, y0 - margin)
+        fx1, fy1 = min(frame.shape[1], x1 + margin), min(frame.shape[0], y1 + margin)
+        filtered = self.apply_color_filter(frame[fy0:fy1, fx0:fx1])
+        return filtered[y0 - fy0:y1 - fy0, x0 - fx0:x1 - fx0]
+
+    def measures_luma(self):
+        """True when detection reads the luma plane only (use_luma and no color filter)."""
+        return self.use_luma and not self.use_color_filter
 
     def get_frame(self, frame_idx=0):
-        # Always set position to ensure we get exactly that frame
-        self.cap.set(cv2.CAP_PROP_POS_FRAMES, frame_idx)
-        ret, frame = self.cap.read()
-        if ret:
+        frame = self.read_frame(frame_idx)
+        if frame is not None:
             return self.apply_color_filter(frame)
         return None
 
+    def strip_profile(self, strip):
+        """Average brightness of every column of the detection strip (rows already cut out)."""
+        if self.measures_luma():
+            return luma_column_means(to_luma(strip))
+        return np.mean(np.mean(strip, axis=2), axis=0)
+
+    def measure_manual_boxes(self, frame):
+        """key_positions entries for the manual boxes inside the frame, with their brightness in frame."""
+        positions = []
+        for m_key in self.manual_keys:
+            x, y, w, h = m_key['x'], m_key['y'], m_key['w'], m_key['h']
+            
+            # Extract the box area
+            y_start, y_end = max(0, y), min(self.height, y + h)
+            x_start, x_end = max(0, x), min(self.width, x + w)
+            
+            if y_end > y_start and x_end > x_start:
+                box_area = frame[y_start:y_end, x_start:x_end]
+                brightness = np.mean(to_luma(box_area) if self.measures_luma() else box_area)
+                
+                positions.append({
+                    'x': x, 'y': y, 'w': w, 'h': h,
+                    'pos': x + w // 2, # for C4 identification if needed
+                    'type': 'manual', 
+                    'brightness': brightness
+                })
+        return positions
+
     def analyze_keyboard(self, frame):
         # Frame is already filtered by get_frame or should be filtered here if passed directly
         # To be safe, we apply filter if it's not already (though usually it is)
         # But if we want to see the effect in real-time, it's better if the caller handles it.
         # For consistency, we assume frame passed here is the "raw" frame from video or filtered.
-        y_px = int(self.height * self.keyboard_y)
-        h_half = self.detection_height // 2
-        y_start = max(0, y_px - h_half)
-        y_end = min(self.height, y_px + h_half + 1)
-        
-        # Extract the keyboard area and calculate average brightness for each column
-        kb_area = frame[y_start:y_end, :, :]
-        kb_line = np.mean(np.mean(kb_area, axis=2), axis=0)
-
         if self.use_manual_mode:
             # In manual mode, positions are pre-defined as regions
-            self.key_positions = []
-            for m_key in self.manual_keys:
-                x, y, w, h = m_key['x'], m_key['y'], m_key['w'], m_key['h']
-                
-                # Extract the box area
-                y_start, y_end = max(0, y), min(self.height, y + h)
-                x_start, x_end = max(0, x), min(self.width, x + w)
-                
-                if y_end > y_start and x_end > x_start:
-                    box_area = frame[y_start:y_end, x_start:x_end, :]
-                    brightness = np.mean(box_area)
-                    
-                    self.key_positions.append({
-                        'x': x, 'y': y, 'w': w, 'h': h,
-                        'pos': x + w // 2, # for C4 identification if needed
-                        'type': 'manual', 
-                        'brightness': brightness
-                    })
+            self.key_positions = self.measure_manual_boxes(frame)
             
             # Use current brightness as base_brightness if not already set or if calibrating
             if not self.base_brightness or len(self.base_brightness) != len(self.key_positions):
@@ -210,6 +425,12 @@ class VideoProcessor:
                 
             return len(self.key_positions)
         
+        # Extract the keyboard area and calculate average brightness for each column
+        _, y_start, y_end = self.get_detection_rows()
+        return self.segment_keyboard(self.strip_profile(frame[y_start:y_end]))
+
+    def segment_keyboard(self, kb_line):
+        """Finds the keys in a strip profile (brightness per column) and sets their base brightness from it."""
         self.key_positions = []
         self.base_brightness = []
         
@@ -221,49 +442,20 @@ class VideoProcessor:
         self.white_threshold = min_b + (max_b - min_b) * self.white_threshold_factor
         self.black_threshold = min_b + (max_b - min_b) * self.black_threshold_factor
         
-        in_white = False
-        in_black = False
-        start_idx = 0
-        
-        # First pass: White keys detection (brightness peaks)
-        for i in range(len(kb_line)):
-            is_white = kb_line[i] > self.white_threshold
-            if is_white:
-                if not in_white:
-                    in_white = True
-                    start_idx = i
-            else:
-                if in_white:
-                    in_white = False
-                    if i - start_idx > 3: # Noise filter
-                        pos = (start_idx + i) // 2
-                        self.key_positions.append({'pos': pos, 'type': 'white', 'brightness': kb_line[pos]})
-        
-        # Handle last key if white and touching the edge
-        if in_white:
-            if len(kb_line) - start_idx > 3:
-                pos = (start_idx + len(kb_line)) // 2
-                self.key_positions.append({'pos': pos, 'type': 'white', 'brightness': kb_line[pos-1]})
-
-        # Second pass: Black keys detection (brightness valleys)
-        for i in range(len(kb_line)):
-            is_black = kb_line[i] < self.black_threshold
-            if is_black:
-                if not in_black:
-                    in_black = True
-                    start_idx = i
-            else:
-                if in_black:
-                    in_black = False
-                    if i - start_idx > 2: # Noise filter
-                        pos = (start_idx + i) // 2
-                        self.key_positions.append({'pos': pos, 'type': 'black', 'brightness': kb_line[pos]})
-
-        # Handle last key if black and touching the edge
-        if in_black:
-            if len(kb_line) - start_idx > 2:
-                pos = (start_idx + len(kb_line)) // 2
-                self.key_positions.append({'pos': pos, 'type': 'black', 'brightness': kb_line[pos-1]})
+        # White keys are the brightness peaks, black keys the valleys; runs not wider
+        # than the noise filter are dropped
+        for key_type, mask, min_width in (
+            ('white', kb_line > self.white_threshold, 3),
+            ('black', kb_line < self.black_threshold, 2),
+        ):
+            starts, ends = find_runs(mask)
+            keep = ends - starts > min_width # Noise filter
+            starts, ends = starts[keep], ends[keep]
+            positions = (starts + ends) // 2
+            # A run touching the right edge takes the brightness of the pixel left of its center
+            samples = np.where(ends == len(kb_line), positions - 1, positions)
+            for pos, brightness in zip(positions.tolist(), kb_line[samples]):
+                self.key_positions.append({'pos': pos, 'type': key_type, 'brightness': brightness})
         
         # Sort key positions from left to right
         self.key_positions.sort(key=lambda x: x['pos'])
@@ -273,6 +465,107 @@ class VideoProcessor:
         
         return len(self.key_positions)
 
+    def calibrate(self, samples=None):
+        """Detects the keys (or measures the manual boxes) and their base brightness; returns the key count.
+
+        With one sample (the default calibration_samples) this is analyze_keyboard() on
+        the filtered start frame. With more, the samples are spread over [start_frame,
+        end_frame) and each is read at the nearest keyframe. The baseline of every column
+        (or box) is its median over the samples, so keys pressed or hidden in a minority
+        of them do not spoil the calibration. Thresholding the median profile amounts to
+        a per-column majority vote of the samples.
+        """
+        samples = self.calibration_samples if samples is None else samples
+        if samples <= 1:
+            frame = self.get_frame(self.start_frame)
+            if frame is None:
+                raise ValueError(f"Cannot read frame {self.start_frame} of {self.video_path}")
+            return self.analyze_keyboard(frame)
+
+        # 1. Sample frames (only the strip rows in automatic mode without the color filter)
+        _, y_start, y_end = self.get_detection_rows()
+        strip_only = not self.use_manual_mode and not self.use_color_filter
+        decoder = open_sampling_decoder(self.backend, self.video_path, threads=self.decoder_threads,
+                                        crop=(0, y_start, self.width, y_end - y_start) if strip_only else None,
+                                        gray=self.measures_luma())
+        frames = []
+        try:
+            last = max(self.start_frame, self.end_frame - 1)
+            for frame_idx in np.linspace(self.start_frame, last, samples).round().astype(int).tolist():
+                frame = decoder.read_keyframe(frame_idx)
+                if frame is not None:
+                    frames.append(frame if strip_only else self.apply_color_filter(frame))
+        finally:
+            decoder.release()
+        if not frames:
+            raise ValueError(f"Cannot read frames {self.start_frame}-{self.end_frame} of {self.video_path}")
+
+        # 2. Median baselines
+        if self.use_manual_mode:
+            self.key_positions = self.measure_manual_boxes(frames[0])
+            per_frame = [[k['brightness'] for k in self.measure_manual_boxes(f)] for f in frames]
+            self.base_brightness = np.median(np.array(per_frame), axis=0).tolist()
+            for key_info, brightness in zip(self.key_positions, self.base_brightness):
+                key_info['brightness'] = brightness
+            return len(self.key_positions)
+        strips = [f if strip_only else f[y_start:y_end] for f in frames]
+        return self.segment_keyboard(np.median([self.strip_profile(s) for s in strips], axis=0))
+
+    def get_detection_rows(self):
+        """Returns (y_px, y_start, y_end) of the horizontal detection strip."""
+        y_px = int(self.height * self.keyboard_y)
+        h_half = self.detection_height // 2
+        y_start = max(0, y_px - h_half)
+        y_end = min(self.height, y_px + h_half + 1)
+        return y_px, y_start, y_end
+
+    def get_detection_roi(self):
+        """Union bounding box (x_start, y_start, x_end, y_end) of every pixel key detection reads."""
+        if self.use_manual_mode:
+            boxes = []
+            for k in self.key_positions:
+                x_s, y_s = max(0, k['x']), max(0, k['y'])
+                x_e, y_e = min(self.width, k['x'] + k['w']), min(self.height, k['y'] + k['h'])
+                if x_e > x_s and y_e > y_s:
+                    boxes.append((x_s, y_s, x_e, y_e))
+            if not boxes:
+                return 0, 0, 0, 0
+            return (min(b[0] for b in boxes), min(b[1] for b in boxes),
+                    max(b[2] for b in boxes), max(b[3] for b in boxes))
+
+        _, y_start, y_end = self.get_detection_rows()
+        if not self.key_positions:
+            return 0, y_start, self.width, y_end
+        columns = [k['pos'] for k in self.key_positions]
+        return min(columns), y_start, max(columns) + 1, y_end
+
+    def get_key_parameters(self):
+        """Per-key (threshold, off_threshold, attack_frames, release_frames) arrays with the overrides applied."""
+        rows = []
+        for i, key_info in enumerate(self.key_positions):
+            values = {"threshold": self.threshold, "off_threshold": self.off_threshold,
+                      "attack_frames": self.attack_frames, "release_frames": self.release_frames}
+            values.update(self.key_type_settings.get(key_info.get('type'), {}))
+            values.update(self.key_settings.get(str(self.start_key + i), {}))
+            if values["off_threshold"] is None:
+                values["off_threshold"] = values["threshold"]
+            rows.append((values["threshold"], values["off_threshold"], values["attack_frames"], values["release_frames"]))
+        on, off, attack, release = np.array(rows, dtype=np.float64).reshape(len(rows), 4).T
+        return on, off, attack.astype(np.int32), release.astype(np.int32)
+
+    def get_frame_stride(self):
+        """Detection stride actually used: frame_stride, at most the shortest debounce limit.
+
+        Only strides up to the shortest attack/release give the result of a full-rate pass
+        (see KeyStateEngine.is_settled). A tracking baseline never settles, so every
+        skipped frame would be measured afterwards, serially: it gets stride 1.
+        """
+        stride = max(1, self.frame_stride)
+        if stride == 1 or self.baseline_rate > 0 or not self.key_positions:
+            return 1
+        _, _, attack, release = self.get_key_parameters()
+        return max(1, min(stride, int(attack.min()), int(release.min())))
+
     def get_c4_index(self):
         """Attempts to identify the index of C4 (MIDI 60) among detected keys."""
         # If no keys are found, we cannot calculate anything
@@ -288,176 +581,454 @@ class VideoProcessor:
             return idx
         return -1
 
-    def convert_to_midi(self, output_path, progress_callback=None, status_callback=None, frame_callback=None, stop_event=None):
-        # We need to access get_text from main if possible, or just use it here if we import it.
-        # But to avoid circular imports, let's just use the callbacks and pass pre-formatted strings from main or just keys.
-        # However, to maintain current structure let's import it here.
-        from main import get_text as get_t
+    def get_measurement_roi(self, index=None):
+        """Region the detector reads: the key ROI, or the whole strip width when recording an index."""
+        if index is not None and not self.use_manual_mode:
+            # The index keeps every column of the strip
+            _, y_start, y_end = self.get_detection_rows()
+            return 0, y_start, self.width, y_end
+        return self.get_detection_roi()
+
+    def make_detector(self, profiler=NULL_PROFILER, index=None, origin=(0, 0)):
+        """Returns detect(frame) -> per-key brightness for the current calibration.
+
+        With an index, detect(frame) returns (brightness, index row) instead. origin is
+        the top-left corner of the incoming frames when the decoder already cropped them.
+        """
+        # Only the bounding box of the strip/boxes is carried through the analysis
+        # (a few percent of the pixels of a 1080p/4K frame)
+        roi = self.get_measurement_roi(index)
+        measure_keys = KeySampler(self, roi)
+        x0, y0, x1, y1 = roi = (roi[0] - origin[0], roi[1] - origin[1], roi[2] - origin[0], roi[3] - origin[1])
+        luma = self.measures_luma()
+        
+        def detect(frame):
+            # With the color filter on, detection runs on the filtered strip (same as calibration)
+            if self.use_color_filter:
+                with profiler.stage("filter"):
+                    region = self.apply_color_filter_roi(frame, roi)
+            else:
+                region = frame[y0:y1, x0:x1]
+            with profiler.stage("strip_reduce"):
+                brightness = measure_keys(region)
+                if index is None:
+                    return brightness
+                if self.use_manual_mode:
+                    return brightness, brightness
+                if luma:
+                    return brightness, to_luma(region).sum(axis=0, dtype=np.uint32)
+                return brightness, region.sum(axis=(0, 2), dtype=np.uint32)
+        return detect
+
+    def open_measurement_source(self, index=None, full_frames=False):
+        """Returns (frame_source, origin, owned) for a measurement pass.
+
+        Backends that crop while decoding get their own decoder delivering only the
+        measured region (plus the filter margin, so the filtered region is unchanged);
+        origin is that region's top-left corner. In luma mode, backends that decode to
+        gray natively also get one (delivering the Y plane of the region). Otherwise, or
+        when full frames are needed (runtime preview), the shared frame source is used.
+        owned means the caller releases the returned source's decoder.
+        """
+        luma = self.measures_luma() and self.decoder.native_gray
+        if full_frames or not (self.decoder.native_crop or luma):
+            return self.frame_source, (0, 0), False
+        x0, y0, x1, y1 = self.get_measurement_roi(index)
+        if self.use_color_filter:
+            margin = self.get_filter_margin()
+            x0, y0 = max(0, x0 - margin), max(0, y0 - margin)
+            x1, y1 = min(self.width, x1 + margin), min(self.height, y1 + margin)
+        if x1 <= x0 or y1 <= y0:
+            return self.frame_source, (0, 0), False
+        decoder = open_decoder(self.backend, self.video_path, threads=self.decoder_threads,
+                               crop=(x0, y0, x1 - x0, y1 - y0), gray=luma)
+        return FrameSource(decoder), (x0, y0), True
+
+    def get_index_key(self):
+        """Everything the stored measurements depend on: the video content and the detection geometry."""
+        if self.video_hash is None:
+            self.video_hash = video_fingerprint(self.video_path)
+        key = {"video": self.video_hash, "width": self.width, "height": self.height}
+        if self.use_manual_mode:
+            key["boxes"] = [[k['x'], k['y'], k['w'], k['h']] for k in self.key_positions]
+        else:
+            _, y_start, y_end = self.get_detection_rows()
+            key["rows"] = [y_start, y_end]
+        if self.use_color_filter:
+            key["filter"] = list(FilterPlan.settings_key(self))
+        elif self.use_luma:
+            key["luma"] = True
+        return key
+
+    def get_checkpoint_key(self):
+        """Everything a conversion's result depends on: video, settings, key geometry/baselines and range."""
+        if self.video_hash is None:
+            self.video_hash = video_fingerprint(self.video_path)
+        return {"video": self.video_hash, "calibration": self.get_calibration(),
+                "key_positions": self.key_positions, "base_brightness": np.asarray(self.base_brightness).tolist(),
+                "start_frame": self.start_frame, "end_frame": self.end_frame, "frame_stride": self.get_frame_stride(),
+                "stream_midi": self.stream_midi}
+
+    def open_index(self, create=True):
+        """Opens (or creates) the .vtm-index of the video for the current geometry; None if unusable."""
+        if self.frame_count <= 0 or not self.key_positions:
+            return None
+        if self.use_manual_mode:
+            columns, dtype, divisor = len(self.key_positions), np.float64, 1
+        else:
+            # Column sums over the strip rows and the 3 channels, or the luma plane (means are sums / divisor)
+            _, y_start, y_end = self.get_detection_rows()
+            divisor = (y_end - y_start) * (1 if self.measures_luma() else 3)
+            columns = self.width
+            dtype = np.uint16 if divisor * 255 <= np.iinfo(np.uint16).max else np.uint32
+        try:
+            return BrightnessIndex.open(BrightnessIndex.path_for(self.video_path), self.get_index_key(),
+                                        self.frame_count, columns, dtype, divisor, create=create)
+        except (OSError, ValueError) as e:
+            logging.warning(f"Brightness index not available: {e}")
+            return None
+
+    def _record_index(self, measurements, index):
+        """Writes the index rows produced by an index detector and yields the usual (frame_idx, brightness, frame)."""
+        try:
+            for frame_idx, (brightness, row), frame in measurements:
+                index.write(frame_idx, row)
+                yield frame_idx, brightness, frame
+        finally:
+            index.flush()
+
+    def _iter_index_measurements(self, index, start_frame, end_frame, chunk=1024):
+        """Replays stored measurements as (frame_idx, brightness, None) without decoding."""
+        columns = None if self.use_manual_mode else np.array([k['pos'] for k in self.key_positions], dtype=np.intp)
+        for a in range(start_frame, end_frame, chunk):
+            b = min(a + chunk, end_frame)
+            block = index.read(a, b, columns)
+            for j in range(b - a):
+                yield a + j, block[j], None
+
+    def measure_range(self, start_frame, end_frame, stop_event=None, queue_size=8, index=None):
+        """Per-frame key brightness for [start_frame, end_frame) as a (frames, keys) array.
+
+        Stops early (fewer rows) at the first frame that cannot be decoded. With an index
+        the measurements are also recorded in it.
+        """
+        source, origin, owned = self.open_measurement_source(index)
+        measurements = FramePipeline(source.read, self.make_detector(index=index, origin=origin),
+                                     range(start_frame, end_frame), queue_size=queue_size, stop_event=stop_event)
+        if index is not None:
+            measurements = self._record_index(measurements, index)
+        try:
+            rows = [brightness for _, brightness, _ in measurements]
+        finally:
+            if owned:
+                source.decoder.release()
+        return np.array(rows, dtype=np.float64).reshape(len(rows), len(self.key_positions))
+
+    def _iter_segment_measurements(self, segments, stop_event=None, record_index=False, first_frame=None):
+        """Measures K contiguous segments in parallel processes and yields (frame_idx, brightness, None) in order.
+
+        Only decoding and measuring run in the workers. The per-key debounce state and the
+        held notes are carried across segment boundaries by the caller, which replays the
+        measurements sequentially, so the result matches a single sequential pass exactly.
+        """
+        first_frame = self.start_frame if first_frame is None else first_frame
+        bounds = np.linspace(first_frame, self.end_frame, segments + 1).astype(int)
+        ranges = [(int(a), int(b)) for a, b in zip(bounds[:-1], bounds[1:]) if b > a]
+        if not ranges:
+            return # Empty frame range (or resumed at its end): nothing to measure
+        calibration = self.get_calibration()
+
+        pool = ProcessPoolExecutor(max_workers=min(len(ranges), os.cpu_count() or 1))
+        try:
+            futures = [
+                pool.submit(_measure_segment, self.video_path, calibration,
+                            self.key_positions, self.base_brightness, a, b, record_index,
+                            self.backend, self.decoder_threads)
+                for a, b in ranges
+            ]
+            # Segments are consumed in order; later ones keep decoding meanwhile
+            for (a, b), future in zip(ranges, futures):
+                series = future.result()
+                for j, brightness in enumerate(series):
+                    yield a + j, brightness, None
+                # A sequential pass stops at the first unreadable frame
+                if len(series) < b - a: break
+                if stop_event and stop_event.is_set(): break
+        finally:
+            pool.shutdown(wait=False, cancel_futures=True)
+
+    def draw_runtime_preview(self, frame, confirmed, y_px, c4_idx):
+        """Returns a copy of frame with the detection strip/boxes and the key states drawn on it."""
+        preview_img = frame.copy()
+        
+        if self.use_manual_mode:
+            for i, key_info in enumerate(self.manual_keys):
+                x, y, w, h = key_info['x'], key_info['y'], key_info['w'], key_info['h']
+                cv2.rectangle(preview_img, (x, y), (x + w, y + h), (0, 255, 255), 2)
+                # Note index/number or name for reference
+                midi_note = self.start_key + i
+                text_label = self.midi_to_note_name(midi_note) if self.show_note_names else str(midi_note)
+                cv2.putText(preview_img, text_label, (x + 2, y + 15), 
+                            cv2.FONT_HERSHEY_SIMPLEX, 0.4, (0, 255, 255), 1)
+        else:
+            cv2.line(preview_img, (0, y_px), (self.width, y_px), (0, 255, 0), 2)
+
+        for i, key_info in enumerate(self.key_positions):
+            # Base color: use the confirmed state for runtime preview for visual stability
+            if confirmed[i]:
+                color = (0, 255, 0) # Green if pressed
+            else:
+                if self.use_manual_mode:
+                    color = (0, 255, 255) # Cyan if manual
+                else:
+                    is_white = key_info['type'] == 'white'
+                    color = (60, 60, 60) if is_white else (255, 255, 255)
+            
+            if self.use_manual_mode:
+                x, y, w, h = key_info['x'], key_info['y'], key_info['w'], key_info['h']
+                pos_x, pos_y = x + w // 2, y + h // 2
+            else:
+                pos_x, pos_y = key_info['pos'], y_px
+
+            if i == c4_idx:
+                cv2.circle(preview_img, (pos_x, pos_y), 8, (0, 0, 255), -1)
+                cv2.putText(preview_img, "C4", (pos_x - 10, pos_y - 15), 
+                            cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 0, 255), 2)
             
-        mid = MidiFile()
-        track = MidiTrack()
-        mid.tracks.append(track)
-        
-        # MIDI Timing (based on previous fixes and set BPM)
-        ticks_per_beat = 480
-        bpm = self.bpm
-        tempo = 60000000 / bpm
-        ms_per_tick = tempo / (ticks_per_beat * 1000)
-        ms_per_frame = 1000 / self.fps
-        
-        # Mapping musical values to ticks (ticks_per_beat = 480, which is a quarter note 1/4)
-        # Whole note 4/4 = 1920
-        # Half note 2/4 = 960
-        # Quarter note 1/4 = 480
-        # Eighth note 1/8 = 240
-        # Sixteenth note 1/16 = 120
-        # Thirty-second note 1/32 = 60
-        # Sixty-fourth note 1/64 = 30
-        quant_map = {
-            "1/1": 1920, "1/2": 960, "1/4": 480, 
-            "1/8": 240, "1/16": 120, "1/32": 60, "1/64": 30
-        }
-        quantization_ticks = quant_map.get(self.quantization_value, 120) if self.use_quantization else 1
-        
-        self.cap.set(cv2.CAP_PROP_POS_FRAMES, self.start_frame)
+            cv2.circle(preview_img, (pos_x, pos_y), 5, color, -1)
         
+        return preview_img
+
+    def convert_to_midi(self, output_path, progress_callback=None, status_callback=None, frame_callback=None, stop_event=None, queue_size=8, segments=1, profiler=None):
+        # No GUI imports here: the callbacks receive raw values and the caller formats them,
+        # so the conversion can also run headless (see cli.py).
         # First pass to calibrate positions if not already done
         if not self.key_positions:
-            ret, frame = self.cap.read()
-            if not ret: return False
-            self.analyze_keyboard(frame)
-            self.cap.set(cv2.CAP_PROP_POS_FRAMES, self.start_frame)
+            try:
+                self.calibrate()
+            except ValueError:
+                return False
             
-        num_keys = len(self.key_positions)
-        last_pressed = [0] * num_keys
-        active_notes = {}
-        last_event_frame = self.start_frame
+        # Detected notes in frames; tempo and quantization are applied by export_midi()
+        notes = NoteEvents(self.fps, self.start_frame)
+        self.note_events = notes
         
-        # Debounce and stability: Track confirmed state and consecutive frames
-        confirmed_pressed = [0] * num_keys
-        consecutive_frames = [0] * num_keys
-        debounce_limit = 2 # Minimum number of frames to confirm state change
+        # Debounce and stability: confirmed state and consecutive frames live in the engine
+        on, off, attack, release = self.get_key_parameters()
+        engine = KeyStateEngine(self.base_brightness, on, attack, baseline_rate=self.baseline_rate,
+                                off_threshold=off, release_limit=release)
         
-        y_px = int(self.height * self.keyboard_y)
-        h_half = self.detection_height // 2
-        y_start = max(0, y_px - h_half)
-        y_end = min(self.height, y_px + h_half + 1)
+        y_px, _, _ = self.get_detection_rows()
         c4_idx = self.get_c4_index()
         
         total_frames_to_process = self.end_frame - self.start_frame
         
-        for count in range(self.start_frame, self.end_frame):
-            if stop_event and stop_event.is_set(): break
-            
-            ret, frame = self.cap.read()
-            if not ret: break
-            
-            kb_line = None
-            if not self.use_manual_mode:
-                kb_area = frame[y_start:y_end, :, :]
-                kb_line = np.mean(np.mean(kb_area, axis=2), axis=0)
-            
-            for i, key_info in enumerate(self.key_positions):
-                if self.use_manual_mode:
-                    x, y, w, h = key_info['x'], key_info['y'], key_info['w'], key_info['h']
-                    # Use predefined areas
-                    y_s, y_e = max(0, y), min(self.height, y + h)
-                    x_s, x_e = max(0, x), min(self.width, x + w)
-                    if y_e > y_s and x_e > x_s:
-                        brightness = np.mean(frame[y_s:y_e, x_s:x_e, :])
-                    else:
-                        brightness = self.base_brightness[i]
-                else:
-                    pos = key_info['pos']
-                    brightness = kb_line[pos]
-                
-                # Instant detection
-                is_pressed_now = abs(brightness - self.base_brightness[i]) > self.threshold
+        # Optional stage profiling (seek/decode are timed inside the frame source)
+        prof = profiler if profiler is not None else NULL_PROFILER
+        processed_frames = 0
+        event_count = 0
+        
+        # Resumable conversions continue from the last checkpoint saved for this output and these settings
+        checkpoint, state = None, None
+        if self.resumable:
+            checkpoint = ConversionCheckpoint(ConversionCheckpoint.path_for(output_path), self.get_checkpoint_key())
+            state = checkpoint.load()
+        # Streamed output: <name>.partial.mid is a valid MIDI file of the notes up to the last checkpoint,
+        # renamed to output_path once the conversion ends
+        writer = None
+        if self.stream_midi:
+            writer_args = (output_path, self.fps, self.start_frame, self.bpm, self.use_quantization, self.quantization_value)
+            if state is not None:
+                try:
+                    writer = MidiStreamWriter(*writer_args, resume=state['writer'])
+                except (OSError, ValueError, KeyError) as e:
+                    logging.warning(f"Cannot continue {output_path} ({e}), converting from the start")
+                    state = None
+            if writer is None:
+                writer = MidiStreamWriter(*writer_args)
+        first_frame = self.start_frame
+        if state is not None:
+            first_frame = checkpoint.restore(state, engine, notes)
+            processed_frames, event_count = state['counters'].tolist()
+            logging.info(f"Resuming from {checkpoint.path} at frame {first_frame}")
+        checkpoint_frames = max(1, int(round(self.checkpoint_seconds * self.fps))) if writer or checkpoint else 0
+        # Velocities are needed during the conversion only by the streamed file (export_midi computes them from the deltas)
+        velocity_curve = self.velocity_curve if self.use_velocity and writer is not None else None
+        next_checkpoint = first_frame + checkpoint_frames
+        
+        index = self.open_index() if self.use_index else None
+        source, owned = self.frame_source, False
+        detect = None # Measures the frames the pipeline passed on unmeasured (frame stride)
+        if index is not None and index.covers(first_frame, self.end_frame):
+            # Every frame was measured before with this geometry: replay thresholding and debounce only
+            logging.info(f"Using brightness index {index.path}")
+            pipeline = None
+            measurements = self._iter_index_measurements(index, first_frame, self.end_frame)
+        elif segments > 1:
+            # Long videos: decode/measure K segments in parallel processes (no runtime preview)
+            pipeline = None
+            measurements = self._iter_segment_measurements(segments, stop_event, record_index=index is not None,
+                                                           first_frame=first_frame)
+        else:
+            # Decode and detection run on their own threads; this thread debounces and emits MIDI
+            source, origin, owned = self.open_measurement_source(index, full_frames=frame_callback is not None)
+            detect = self.make_detector(prof, index, origin)
+            # The index needs every frame measured
+            stride = self.get_frame_stride() if index is None else 1
+            if index is None and stride < self.frame_stride:
+                reason = "baseline tracking needs every frame" if self.baseline_rate > 0 else \
+                    "a larger stride than the shortest debounce can miss presses"
+                logging.warning(f"Frame stride {self.frame_stride} reduced to {stride}: {reason}")
+            pipeline = FramePipeline(
+                source.read, detect, range(first_frame, self.end_frame),
+                queue_size=queue_size,
+                keep_frame=(lambda idx: idx % 2 == 0) if frame_callback else None, # Update every 2 frames for performance
+                stop_event=stop_event,
+                measure_frame=(lambda idx: (idx - self.start_frame) % stride == 0) if stride > 1 else None
+            )
+            measurements = self._record_index(pipeline, index) if index is not None else pipeline
+        t_start = time.perf_counter()
+        prof.start()
+        if profiler is not None:
+            source.profiler = profiler
+        
+        def evaluate(count, brightness, frame):
+            # brightness None: a skipped frame known to change nothing (see KeyStateEngine.is_settled)
+            nonlocal processed_frames, event_count
+            if brightness is not None:
+                with prof.stage("key_eval"):
+                    changed = engine.update(brightness)
                 
-                # Debounce Logic: State change must last at least debounce_limit frames
-                if is_pressed_now != confirmed_pressed[i]:
-                    consecutive_frames[i] += 1
-                    if consecutive_frames[i] >= debounce_limit:
-                        # State change CONFIRMED
-                        confirmed_pressed[i] = is_pressed_now
-                        consecutive_frames[i] = 0
-                        
-                        # Send MIDI event if the state has changed since the last event sent
-                        if confirmed_pressed[i] != last_pressed[i]:
-                            note = self.start_key + i
-                            delta_ms = (count - last_event_frame) * ms_per_frame
-                            delta_ticks = int(delta_ms / ms_per_tick)
-                            
-                            if confirmed_pressed[i]:
-                                # If quantization is active, round delta_ticks to nearest sixteenth note
-                                if self.use_quantization:
-                                    delta_ticks = round(delta_ticks / quantization_ticks) * quantization_ticks
-                                
-                                track.append(Message('note_on', note=note, velocity=64, time=delta_ticks))
-                                active_notes[note] = count
-                            else:
-                                if self.use_quantization:
-                                    delta_ticks = round(delta_ticks / quantization_ticks) * quantization_ticks
-                                
-                                track.append(Message('note_off', note=note, velocity=127, time=delta_ticks))
-                                if note in active_notes: del active_notes[note]
-                                
-                            last_event_frame = count
-                            last_pressed[i] = confirmed_pressed[i]
-                else:
-                    consecutive_frames[i] = 0 # Reset if the state returns to the confirmed one
+                # Record note events only for the keys whose confirmed state changed (left to right)
+                if changed.size:
+                    t_append = time.perf_counter()
+                    deltas = np.abs(brightness[changed] - engine.base[changed])
+                    velocity = velocities(deltas, velocity_curve) if velocity_curve is not None else None
+                    for j, i in enumerate(changed.tolist()):
+                        if engine.confirmed[i]:
+                            notes.note_on(i, self.start_key + i, count, float(deltas[j]))
+                            if writer is not None:
+                                writer.note_on(count, self.start_key + i, None if velocity is None else int(velocity[j]))
+                        else:
+                            notes.note_off(i, count)
+                            if writer is not None:
+                                writer.note_off(count, self.start_key + i)
+                    prof.add("midi_append", time.perf_counter() - t_append)
+                    event_count += changed.size
+            processed_frames += 1
             
             # Runtime Preview (frame callback)
-            if frame_callback and count % 2 == 0: # Update every 2 frames for performance
-                preview_img = frame.copy()
-                
-                if self.use_manual_mode:
-                    for i, key_info in enumerate(self.manual_keys):
-                        x, y, w, h = key_info['x'], key_info['y'], key_info['w'], key_info['h']
-                        cv2.rectangle(preview_img, (x, y), (x + w, y + h), (0, 255, 255), 2)
-                        # Note index/number or name for reference
-                        midi_note = self.start_key + i
-                        text_label = self.midi_to_note_name(midi_note) if self.show_note_names else str(midi_note)
-                        cv2.putText(preview_img, text_label, (x + 2, y + 15), 
-                                    cv2.FONT_HERSHEY_SIMPLEX, 0.4, (0, 255, 255), 1)
-                else:
-                    cv2.line(preview_img, (0, y_px), (self.width, y_px), (0, 255, 0), 2)
-
-                for i, key_info in enumerate(self.key_positions):
-                    # Base color: use confirmed_pressed for runtime preview for visual stability
-                    if confirmed_pressed[i]:
-                        color = (0, 255, 0) # Green if pressed
-                    else:
-                        if self.use_manual_mode:
-                            color = (0, 255, 255) # Cyan if manual
-                        else:
-                            is_white = key_info['type'] == 'white'
-                            color = (60, 60, 60) if is_white else (255, 255, 255)
-                    
-                    if self.use_manual_mode:
-                        x, y, w, h = key_info['x'], key_info['y'], key_info['w'], key_info['h']
-                        pos_x, pos_y = x + w // 2, y + h // 2
-                    else:
-                        pos_x, pos_y = key_info['pos'], y_px
-
-                    if i == c4_idx:
-                        cv2.circle(preview_img, (pos_x, pos_y), 8, (0, 0, 255), -1)
-                        cv2.putText(preview_img, "C4", (pos_x - 10, pos_y - 15), 
-                                    cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 0, 255), 2)
-                    
-                    cv2.circle(preview_img, (pos_x, pos_y), 5, color, -1)
-                
-                frame_callback(preview_img)
+            if frame is not None:
+                with prof.stage("preview"):
+                    frame_callback(self.draw_runtime_preview(frame, engine.confirmed, y_px, c4_idx))
 
             if status_callback and count % 5 == 0:
-                status_callback(count - self.start_frame, total_frames_to_process)
+                processed = count - self.start_frame
+                elapsed = time.perf_counter() - t_start
+                # Speed of this run only (a resumed conversion starts at first_frame)
+                info = {'fps': (count - first_frame + 1) / elapsed if elapsed > 0 else 0.0}
+                if pipeline is not None:
+                    info['decode_queue'], info['detect_queue'] = pipeline.depths()
+                    info['queue_size'] = queue_size
+                status_callback(processed, total_frames_to_process, info)
 
             if progress_callback and count % 10 == 0:
                 progress_callback((count - self.start_frame) / total_frames_to_process)
-                
+
+        def evaluate_skipped(skipped, settled):
+            # Frames between two samples: measured only if a key may have changed in between
+            for idx, frame in skipped:
+                preview = frame if frame_callback and idx % 2 == 0 else None
+                evaluate(idx, None if settled else detect(frame), preview)
+            skipped.clear()
+
+        def save_checkpoint(count):
+            # After a measured frame only: a resumed stride keeps the same samples and skipped frames
+            nonlocal next_checkpoint
+            with prof.stage("checkpoint"):
+                if writer is not None:
+                    writer.checkpoint()
+                if checkpoint is not None:
+                    checkpoint.save(count + 1, engine, notes, writer, (processed_frames, event_count))
+            while next_checkpoint <= count:
+                next_checkpoint += checkpoint_frames
+
+        skipped = [] # (frame_idx, frame) of the unmeasured frames since the last sample
+        finished = False # Loop left without an exception (end of range or stop request)
+        try:
+            for count, brightness, frame in measurements:
+                if stop_event and stop_event.is_set(): break
+                if brightness is None:
+                    skipped.append((count, frame))
+                    continue
+                if skipped:
+                    evaluate_skipped(skipped, engine.is_settled(brightness))
+                evaluate(count, brightness, frame)
+                if checkpoint_frames and count >= next_checkpoint:
+                    save_checkpoint(count)
+            else:
+                # Frames after the last sample
+                evaluate_skipped(skipped, False)
+            finished = True
+        finally:
+            source.profiler = None
+            if writer is not None:
+                # A stopped resumable conversion keeps its partial file for the next run
+                resumes = checkpoint is not None and stop_event is not None and stop_event.is_set()
+                with prof.stage("midi_export"):
+                    writer.close(finalize=finished and not resumes)
+            prof.stop()
+            if owned:
+                source.decoder.release()
+            if index is not None:
+                index.close()
+        
+        if profiler is not None:
+            profiler.frames = processed_frames
+            profiler.frames_dropped = total_frames_to_process - processed_frames
+            profiler.events = event_count
+            if self.use_color_filter:
+                profiler.extra['filter_stages'] = self.get_filter_timings()
+        
+        if writer is None:
+            with prof.stage("midi_export"):
+                self.export_midi(output_path)
+        stopped = bool(stop_event and stop_event.is_set())
+        if checkpoint is not None and not stopped:
+            checkpoint.remove()
+        return not stopped
+
+    def export_midi(self, output_path, note_events=None):
+        """Writes the notes of the last conversion (or note_events) with the current BPM/quantization/velocity.
+
+        Only the MIDI timing and velocities are computed here, so it can be re-run with other MIDI
+        settings without decoding the video again.
+        """
+        if note_events is None:
+            note_events = self.note_events
+        if note_events is None:
+            raise ValueError("No note events: convert the video first")
+        mid = note_events.to_midi(self.bpm, self.use_quantization, self.quantization_value,
+                                  velocity_curve=self.velocity_curve if self.use_velocity else None)
         mid.save(output_path)
-        return not (stop_event and stop_event.is_set())
 
     def __del__(self):
-        if hasattr(self, 'cap'):
-            self.cap.release()
+        if hasattr(self, 'decoder'):
+            self.decoder.release()
+
+def _measure_segment(video_path, calibration, key_positions, base_brightness, start_frame, end_frame, record_index=False,
+                     backend="opencv", decoder_threads=0):
+    """Worker process entry point for parallel segment conversion (see _iter_segment_measurements)."""
+    cv2.setNumThreads(1)
+    processor = VideoProcessor(video_path, backend=backend, decoder_threads=decoder_threads)
+    processor.set_calibration(calibration)
+    # Same key positions/baselines as the parent, no recalibration on the segment start
+    processor.key_positions = key_positions
+    processor.base_brightness = base_brightness
+    # The parent already created the index file, segments write disjoint rows of it
+    index = processor.open_index(create=False) if record_index else None
+    try:
+        return processor.measure_range(start_frame, end_frame, index=index)
+    finally:
+        if index is not None:
+            index.close()
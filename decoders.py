@@ -0,0 +1,331 @@
+﻿import os
+import re
+import shutil
+import subprocess
+import tempfile
+import cv2
+import numpy as np
+
+try:
+    import av # PyAV (optional)
+except ImportError:
+    av = None
+
+def probe_video(path):
+    """(fps, width, height, frame_count) as reported by OpenCV, shared by every backend
+    so frame indices mean the same thing whichever decoder is used."""
+    cap = cv2.VideoCapture(path)
+    try:
+        return (cap.get(cv2.CAP_PROP_FPS), int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)),
+                int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT)), int(cap.get(cv2.CAP_PROP_FRAME_COUNT)))
+    finally:
+        cap.release()
+
+class Decoder:
+    """Sequential video decoder with seeking, the interface FrameSource reads through.
+
+    seek(idx) makes the next read()/grab() return frame idx, grab() skips a frame as
+    cheaply as the backend allows and read() returns the next frame (or None at the
+    end). crop=(x, y, w, h) and gray=True restrict the output to a region / the luma
+    plane; backends with native_crop / native_gray do it inside the decoder, the
+    others after it.
+    """
+    name = None
+    native_crop = False
+    native_gray = False
+    keyframe_seek = False # read_keyframe() stops at the preceding keyframe
+
+    def __init__(self, path, threads=0, crop=None, gray=False):
+        self.path = path
+        self.threads = threads # 0 = backend default
+        self.crop = crop
+        self.gray = gray
+
+    def _set_info(self, fps, width, height, frame_count):
+        self.fps, self.width, self.height, self.frame_count = fps, width, height, frame_count
+
+    def _postprocess(self, frame):
+        # Crop/gray for backends that cannot do it while decoding
+        if self.crop is not None:
+            x, y, w, h = self.crop
+            frame = frame[y:y + h, x:x + w]
+        if self.gray:
+            frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        return frame
+
+    def seek(self, frame_idx):
+        raise NotImplementedError
+
+    def grab(self):
+        return self.read() is not None
+
+    def read(self):
+        raise NotImplementedError
+
+    def read_keyframe(self, frame_idx):
+        """Returns a frame at or shortly before frame_idx, as cheaply as the backend allows.
+
+        For callers that only need some frame near frame_idx (calibration samples):
+        backends that can stop at the preceding keyframe return it instead of decoding
+        up to frame_idx. Call seek() before reading sequentially again.
+        """
+        self.seek(frame_idx)
+        return self.read()
+
+    def release(self):
+        pass
+
+class OpenCVDecoder(Decoder):
+    """cv2.VideoCapture (the default)."""
+    name = "opencv"
+
+    def __init__(self, path, threads=0, crop=None, gray=False):
+        super().__init__(path, threads, crop, gray)
+        if threads and hasattr(cv2, "CAP_PROP_N_THREADS"):
+            self.cap = cv2.VideoCapture(path, cv2.CAP_ANY, [cv2.CAP_PROP_N_THREADS, threads])
+        else:
+            self.cap = cv2.VideoCapture(path)
+        self._set_info(self.cap.get(cv2.CAP_PROP_FPS), int(self.cap.get(cv2.CAP_PROP_FRAME_WIDTH)),
+                       int(self.cap.get(cv2.CAP_PROP_FRAME_HEIGHT)), int(self.cap.get(cv2.CAP_PROP_FRAME_COUNT)))
+
+    def seek(self, frame_idx):
+        self.cap.set(cv2.CAP_PROP_POS_FRAMES, frame_idx)
+
+    def grab(self):
+        # Skips the color conversion of the frame
+        return self.cap.grab()
+
+    def read(self):
+        ret, frame = self.cap.read()
+        if not ret:
+            return None
+        if self.crop is None and not self.gray:
+            return frame
+        return self._postprocess(frame)
+
+    def release(self):
+        self.cap.release()
+
+class PyAVDecoder(Decoder):
+    """PyAV (libav* bindings): frame-threaded decoding and direct conversion to gray."""
+    name = "pyav"
+    native_gray = True # Reads the Y plane instead of converting to BGR
+    keyframe_seek = True
+
+    def __init__(self, path, threads=0, crop=None, gray=False):
+        if av is None:
+            raise ImportError("The pyav backend needs PyAV (pip install av)")
+        super().__init__(path, threads, crop, gray)
+        self._set_info(*probe_video(path))
+        self.container = av.open(path)
+        self.stream = self.container.streams.video[0]
+        self.stream.thread_type = "AUTO"
+        if threads:
+            self.stream.thread_count = threads
+        self.time_base = float(self.stream.time_base)
+        self.start_pts = self.stream.start_time or 0
+        self.frames = self.container.decode(self.stream)
+        self.next_idx = 0 # Index of the next frame to return
+        self.decoded_idx = -1 # Index of the last frame the decoder produced
+
+    def _index_of(self, frame):
+        if frame.pts is None:
+            return self.decoded_idx + 1
+        return int(round((frame.pts - self.start_pts) * self.time_base * self.fps))
+
+    def _next(self):
+        # Decodes until the frame at next_idx (frames before it come from seeking back to a keyframe)
+        while True:
+            frame = next(self.frames, None)
+            if frame is None:
+                return None
+            self.decoded_idx = self._index_of(frame)
+            if self.decoded_idx >= self.next_idx:
+                self.next_idx = self.decoded_idx + 1
+                return frame
+
+    def seek(self, frame_idx):
+        if frame_idx == self.next_idx:
+            return
+        if frame_idx < self.next_idx or frame_idx > self.decoded_idx + 1:
+            target = self.start_pts + int(frame_idx / self.fps / self.time_base)
+            self.container.seek(target, stream=self.stream, backward=True, any_frame=False)
+            self.frames = self.container.decode(self.stream)
+            self.decoded_idx = -1
+        self.next_idx = frame_idx
+
+    def grab(self):
+        return self._next() is not None
+
+    def read(self):
+        frame = self._next()
+        if frame is None:
+            return None
+        return self._to_image(frame)
+
+    def read_keyframe(self, frame_idx):
+        target = self.start_pts + int(frame_idx / self.fps / self.time_base)
+        self.container.seek(target, stream=self.stream, backward=True, any_frame=False)
+        self.frames = self.container.decode(self.stream)
+        frame = next(self.frames, None)
+        if frame is None:
+            self.decoded_idx = -1
+            return None
+        self.decoded_idx = self._index_of(frame)
+        self.next_idx = self.decoded_idx + 1
+        return self._to_image(frame)
+
+    def _to_image(self, frame):
+        if self.gray:
+            image = frame.to_ndarray(format="gray")
+        else:
+            image = frame.to_ndarray(format="bgr24")
+        if self.crop is not None:
+            x, y, w, h = self.crop
+            image = image[y:y + h, x:x + w]
+        return image
+
+    def release(self):
+        self.container.close()
+
+_PASSTHROUGH_FLAGS = {} # ffmpeg executable -> option keeping every decoded frame
+
+def ffmpeg_passthrough_flag(ffmpeg):
+    """-fps_mode (ffmpeg 5.1+) or -vsync (older releases, which reject -fps_mode)."""
+    if ffmpeg not in _PASSTHROUGH_FLAGS:
+        try:
+            out = subprocess.run([ffmpeg, "-version"], capture_output=True, text=True, timeout=10).stdout
+        except (OSError, subprocess.SubprocessError):
+            out = ""
+        # Release builds print "ffmpeg version 4.4.2-..." (or "n6.1"); git builds have no number and are recent
+        m = re.search(r"version\s+n?(\d+)\.(\d+)", out)
+        old = m is not None and (int(m.group(1)), int(m.group(2))) < (5, 1)
+        _PASSTHROUGH_FLAGS[ffmpeg] = "-vsync" if old else "-fps_mode"
+    return _PASSTHROUGH_FLAGS[ffmpeg]
+
+class FFmpegPipeDecoder(Decoder):
+    """Raw frames from an ffmpeg process over stdout.
+
+    Cropping and the gray conversion run inside ffmpeg, so only the requested pixels
+    cross the pipe (a detection strip is a few percent of a frame). Seeking restarts
+    the process at the frame timestamp, so it suits sequential reads best.
+    """
+    name = "ffmpeg"
+    native_crop = True
+    native_gray = True
+    keyframe_seek = True
+    CROP_PAD = 4 # Context kept around the crop so the chroma upsampling of its border is unaffected
+
+    def __init__(self, path, threads=0, crop=None, gray=False, ffmpeg=None):
+        super().__init__(path, threads, crop, gray)
+        self.ffmpeg = ffmpeg or os.environ.get("VTM_FFMPEG") or shutil.which("ffmpeg")
+        if not self.ffmpeg:
+            raise FileNotFoundError("The ffmpeg backend needs the ffmpeg executable on PATH (or VTM_FFMPEG)")
+        self._set_info(*probe_video(path))
+        if crop is not None:
+            # ffmpeg crops subsampled (4:2:0) frames on even coordinates: fetch an aligned,
+            # slightly larger box and cut the requested region out of it
+            x, y, w, h = crop
+            fx, fy = max(0, x - self.CROP_PAD) // 2 * 2, max(0, y - self.CROP_PAD) // 2 * 2
+            fx1, fy1 = min(self.width, x + w + self.CROP_PAD), min(self.height, y + h + self.CROP_PAD)
+            self.fetch = (fx, fy, fx1 - fx, fy1 - fy)
+            self.inner = (slice(y - fy, y - fy + h), slice(x - fx, x - fx + w))
+        else:
+            self.fetch = None
+            self.inner = None
+        _, _, w, h = self.fetch if self.fetch is not None else (0, 0, self.width, self.height)
+        self.shape = (h, w) if gray else (h, w, 3)
+        self.frame_bytes = int(np.prod(self.shape))
+        self.proc = None
+        self.next_idx = 0
+
+    def _start(self, frame_idx, accurate=True):
+        self._stop()
+        cmd = [self.ffmpeg, "-v", "error", "-nostdin"]
+        if self.threads:
+            cmd += ["-threads", str(self.threads)]
+        if frame_idx > 0:
+            # Accurate seek: ffmpeg drops the frames before this time. A quarter frame early so
+            # rounding to the stream time base never lands after the target frame.
+            # Otherwise output starts at the keyframe before it
+            if not accurate:
+                cmd += ["-noaccurate_seek"]
+            cmd += ["-ss", f"{(frame_idx - 0.25) / self.fps:.6f}"]
+        cmd += ["-i", self.path, "-an", "-sn", ffmpeg_passthrough_flag(self.ffmpeg), "passthrough"]
+        if self.fetch is not None:
+            x, y, w, h = self.fetch
+            cmd += ["-vf", f"crop={w}:{h}:{x}:{y}:exact=1"]
+        cmd += ["-f", "rawvideo", "-pix_fmt", "gray" if self.gray else "bgr24", "-"]
+        # ffmpeg's messages go to a file (a pipe nobody reads could fill up and block it)
+        self.stderr = tempfile.TemporaryFile()
+        self.proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=self.stderr,
+                                     bufsize=self.frame_bytes * 4)
+        self.next_idx = frame_idx
+
+    def _stop(self):
+        if self.proc is not None:
+            self.proc.kill()
+            self.proc.stdout.close()
+            self.proc.wait()
+            self.proc = None
+            self.stderr.close()
+
+    def _check_exit(self):
+        # A short read is the end of the video only if ffmpeg finished normally
+        returncode = self.proc.wait()
+        if returncode != 0:
+            self.stderr.seek(0)
+            message = self.stderr.read().decode('utf-8', 'replace').strip()
+            self._stop()
+            raise RuntimeError(f"ffmpeg failed on {self.path} (exit code {returncode}): "
+                               f"{'; '.join(message.splitlines()[-3:]) or 'no error message'}")
+
+    def seek(self, frame_idx):
+        if self.proc is None or frame_idx != self.next_idx:
+            self._start(frame_idx)
+
+    def read(self):
+        if self.proc is None:
+            self._start(self.next_idx)
+        data = self.proc.stdout.read(self.frame_bytes)
+        if len(data) < self.frame_bytes:
+            self._check_exit()
+            return None
+        self.next_idx += 1
+        frame = np.frombuffer(data, dtype=np.uint8).reshape(self.shape)
+        return frame[self.inner] if self.inner is not None else frame
+
+    def read_keyframe(self, frame_idx):
+        self._start(frame_idx, accurate=False)
+        frame = self.read()
+        # The stream position is unknown now: the next read restarts at frame_idx
+        self._stop()
+        self.next_idx = frame_idx
+        return frame
+
+    def release(self):
+        self._stop()
+
+BACKENDS = {cls.name: cls for cls in (OpenCVDecoder, PyAVDecoder, FFmpegPipeDecoder)}
+
+def open_decoder(backend, path, threads=0, crop=None, gray=False):
+    """Creates the decoder of the given backend name ("opencv", "pyav" or "ffmpeg")."""
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown decoder backend: {backend} (available: {', '.join(BACKENDS)})")
+    return BACKENDS[backend](path, threads=threads, crop=crop, gray=gray)
+
+def open_sampling_decoder(backend, path, threads=0, crop=None, gray=False):
+    """Decoder for reading a few scattered frames with read_keyframe().
+
+    OpenCV always decodes up to the exact frame after a seek (up to a whole GOP on
+    H.264), so when the backend cannot stop at keyframes PyAV or ffmpeg is used if
+    installed; both deliver the same frames. Falls back to the backend itself.
+    """
+    for name in [backend] + [n for n in ("pyav", "ffmpeg") if n != backend]:
+        if not BACKENDS[name].keyframe_seek:
+            continue
+        try:
+            return open_decoder(name, path, threads=threads, crop=crop, gray=gray)
+        except (ImportError, FileNotFoundError):
+            continue
+    return open_decoder(backend, path, threads=threads, crop=crop, gray=gray)
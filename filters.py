@@ -0,0 +1,178 @@
+﻿import cv2
+import numpy as np
+import threading
+import time
+
+class FilterPlan:
+    """The "shader" filter settings compiled once into reusable LUTs, kernels and buffers.
+
+    Built whenever a filter slider changes, then applied to every preview/conversion
+    frame. Contrast, brightness and gamma are folded into a single 256-entry LUT and
+    intermediate images are written into preallocated buffers, so a frame costs no
+    Python-level table building and almost no allocations. The output is identical to
+    the step-by-step pipeline it replaces.
+    """
+    STAGES = ["adjust", "edges", "blur", "hsv", "morphology", "compose"]
+    MAX_BUFFERS = 32
+
+    def __init__(self, processor, timings=None):
+        p = processor
+        self.key = self.settings_key(p)
+
+        # 1 + 2. Contrast/Brightness (convertScaleAbs) and gamma as one combined LUT
+        identity = np.arange(256, dtype=np.uint8).reshape(1, 256)
+        lut = cv2.convertScaleAbs(identity, alpha=p.contrast, beta=p.brightness).reshape(256)
+        if p.gamma != 1.0:
+            inv_gamma = 1.0 / p.gamma
+            gamma_table = np.array([((i / 255.0) ** inv_gamma) * 255 for i in np.arange(0, 256)]).astype("uint8")
+            lut = gamma_table[lut]
+        self.lut = np.ascontiguousarray(lut)
+
+        self.edge_detection = p.edge_detection
+        self.blur_ksize = (p.blur_size * 2 + 1,) * 2 if p.blur_size > 0 else None
+        self.hsv_min = np.array(p.hsv_min)
+        self.hsv_max = np.array(p.hsv_max)
+        self.invert_mask = p.invert_mask
+        self.kernel = np.ones((3, 3), np.uint8)
+        self.filter_iterations = p.filter_iterations
+        self.dilate_iterations = p.dilate_iterations
+
+        self.use_contour_filling = p.use_contour_filling
+        self.show_binary_mask = p.show_binary_mask
+        self.contour_color = p.contour_color
+        self.min_contour_area = p.min_contour_area
+        self.use_intelligent_filter = p.use_intelligent_filter
+        self.min_aspect_ratio = p.min_aspect_ratio
+
+        self.buffers = {} # (name, shape) -> preallocated intermediate image
+        self.lock = threading.Lock()
+        # Cumulative seconds and calls per stage (shared across recompiled plans if passed in)
+        self.timings = timings if timings is not None else {}
+
+    @staticmethod
+    def settings_key(p):
+        """Everything the compiled plan depends on; a different key means the plan is stale."""
+        return (
+            p.contrast, p.brightness, p.gamma, p.edge_detection, p.blur_size,
+            tuple(int(v) for v in p.hsv_min), tuple(int(v) for v in p.hsv_max),
+            p.invert_mask, p.filter_iterations, p.dilate_iterations,
+            p.use_contour_filling, p.show_binary_mask, tuple(p.contour_color),
+            p.min_contour_area, p.use_intelligent_filter, p.min_aspect_ratio,
+        )
+
+    def _buffer(self, name, shape):
+        buf = self.buffers.get((name, shape))
+        if buf is None:
+            if len(self.buffers) >= self.MAX_BUFFERS:
+                self.buffers.clear() # Region sizes changed a lot (e.g. slider drags), start over
+            buf = np.empty(shape, dtype=np.uint8)
+            self.buffers[(name, shape)] = buf
+        return buf
+
+    def _record(self, stage, t0):
+        now = time.perf_counter()
+        entry = self.timings.setdefault(stage, [0.0, 0])
+        entry[0] += now - t0
+        entry[1] += 1
+        return now
+
+    def apply(self, frame):
+        """Filters frame (BGR) and returns a newly allocated BGR image."""
+        with self.lock:
+            h, w = frame.shape[:2]
+            t = time.perf_counter()
+
+            # 1 + 2. Adjustments through the combined LUT
+            frame_adj = cv2.LUT(frame, self.lut, dst=self._buffer("adj", (h, w, 3)))
+            t = self._record("adjust", t)
+
+            # 2b. Edge Detection (optional)
+            if self.edge_detection:
+                gray = cv2.cvtColor(frame_adj, cv2.COLOR_BGR2GRAY, dst=self._buffer("gray", (h, w)))
+                edges = cv2.Canny(gray, 50, 150, edges=self._buffer("edges", (h, w)))
+                edges_bgr = cv2.cvtColor(edges, cv2.COLOR_GRAY2BGR, dst=self._buffer("edges_bgr", (h, w, 3)))
+                frame_adj = cv2.addWeighted(frame_adj, 0.7, edges_bgr, 0.3, 0, dst=self._buffer("adj_edges", (h, w, 3)))
+                t = self._record("edges", t)
+
+            # 3. Gaussian Blur to reduce noise/sparkles
+            if self.blur_ksize:
+                frame_adj = cv2.GaussianBlur(frame_adj, self.blur_ksize, 0, dst=self._buffer("blur", (h, w, 3)))
+                t = self._record("blur", t)
+
+            # 4. HSV Filtering
+            hsv = cv2.cvtColor(frame_adj, cv2.COLOR_BGR2HSV, dst=self._buffer("hsv", (h, w, 3)))
+            mask = cv2.inRange(hsv, self.hsv_min, self.hsv_max, dst=self._buffer("mask", (h, w)))
+
+            # 5. Invert mask if requested
+            if self.invert_mask:
+                mask = cv2.bitwise_not(mask, dst=mask)
+            t = self._record("hsv", t)
+
+            # 6. Morphological operations
+            if self.filter_iterations > 0 or self.dilate_iterations > 0:
+                tmp = self._buffer("mask_tmp", (h, w))
+                if self.filter_iterations > 0:
+                    tmp = cv2.morphologyEx(mask, cv2.MORPH_OPEN, self.kernel, dst=tmp, iterations=self.filter_iterations)
+                    mask = cv2.morphologyEx(tmp, cv2.MORPH_CLOSE, self.kernel, dst=mask, iterations=self.filter_iterations)
+
+                # 6b. Extra Dilate to expand thin edges/notes
+                if self.dilate_iterations > 0:
+                    mask = cv2.dilate(mask, self.kernel, dst=tmp, iterations=self.dilate_iterations)
+                t = self._record("morphology", t)
+
+            # 7. Apply mask to keep original colors or show binary
+            if self.use_contour_filling:
+                filtered = self._fill_contours(mask, frame_adj.shape)
+            elif self.show_binary_mask:
+                filtered = cv2.cvtColor(mask, cv2.COLOR_GRAY2BGR)
+            else:
+                filtered = cv2.bitwise_and(frame_adj, frame_adj, mask=mask)
+            self._record("compose", t)
+            return filtered
+
+    def _fill_contours(self, mask, shape):
+        # Create a black background image
+        filtered = np.zeros(shape, dtype=np.uint8)
+        # Find contours on the binary mask
+        contours, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+
+        # Filter contours by minimum area (to remove small particles)
+        filtered_contours = []
+        for cnt in contours:
+            area = cv2.contourArea(cnt)
+            if area < self.min_contour_area:
+                continue
+
+            if self.use_intelligent_filter:
+                # Falling notes are usually vertical rectangles
+                x, y, w, h = cv2.boundingRect(cnt)
+                aspect_ratio = float(h) / w
+                # Check if it's "note-like" (vertical and relatively rectangular)
+                # Note: particles are often circular or scattered
+                if aspect_ratio < self.min_aspect_ratio:
+                    continue
+                # Rectangularity check: area / (w*h) should be high
+                rect_area = w * h
+                if rect_area > 0:
+                    rectangularity = area / rect_area
+                    if rectangularity < 0.5: # At least 50% of the bounding box
+                        continue
+
+            filtered_contours.append(cnt)
+
+        # Draw filtered contours filled with solid chosen color
+        cv2.drawContours(filtered, filtered_contours, -1, self.contour_color, thickness=-1)
+        return filtered
+
+    def timing_report(self):
+        """Per-stage {'total_ms', 'calls', 'avg_ms'} accumulated since the timings were created."""
+        report = {}
+        for stage in self.STAGES:
+            if stage in self.timings:
+                total, calls = self.timings[stage]
+                report[stage] = {
+                    "total_ms": total * 1000.0,
+                    "calls": calls,
+                    "avg_ms": total * 1000.0 / calls if calls else 0.0,
+                }
+        return report
@@ -67,6 +67,13 @@ sys.excepthook = handle_exception
 # Add current path to import core
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 from core import VideoProcessor
+from profiler import StageProfiler
+from filters import FilterPlan
+from preview import PreviewRenderer, fit_to_canvas
+
+PREVIEW_REFRESH_MS = 33 # The GUI shows conversion progress/preview at most ~30 times per second
+ROBUST_CALIBRATION_SAMPLES = 9 # Frames sampled by the robust calibration switch
+TRACKING_BASELINE_RATE = 0.05 # Baseline EMA weight per frame of the lighting tracking switch
 
 ctk.set_appearance_mode("Dark")
 ctk.set_default_color_theme("blue")
@@ -93,6 +100,10 @@ class ModernApp(ctk.CTk):
         self.is_converting = False
         self.is_playing = False
         self.last_preview_frame = None
+        self.preview_renderer = None # Runtime preview worker while converting
+        self.pending_progress = None # Latest progress/status from the conversion, shown by the UI refresh
+        self.pending_status = None
+        self.ui_refresh_job = None
         self.stop_event = threading.Event()
         self.play_thread = None
         self.target_frame_selector = "start" # "start" or "end"
@@ -118,6 +129,31 @@ class ModernApp(ctk.CTk):
         self.load_btn = ctk.CTkButton(self.tab_video, text=get_text("load_video"), command=self.load_video)
         self.load_btn.pack(pady=10, padx=10, fill="x")
 
+        self.calib_frame = ctk.CTkFrame(self.tab_video, fg_color="transparent")
+        self.calib_frame.pack(pady=(0, 5), padx=10, fill="x")
+
+        self.save_calib_btn = ctk.CTkButton(self.calib_frame, text=get_text("save_calib_btn"), command=self.save_calibration, width=120)
+        self.save_calib_btn.pack(side="left", expand=True, padx=2)
+
+        self.load_calib_btn = ctk.CTkButton(self.calib_frame, text=get_text("load_calib_btn"), command=self.load_calibration, width=120)
+        self.load_calib_btn.pack(side="right", expand=True, padx=2)
+
+        # Re-conversions with other thresholds replay the stored measurements instead of decoding
+        self.index_switch = ctk.CTkSwitch(self.tab_video, text=get_text("index_switch"))
+        self.index_switch.pack(pady=5, padx=10)
+
+        # Detection on the Y plane only: less data to decode and reduce (ignored with the color filter)
+        self.luma_switch = ctk.CTkSwitch(self.tab_video, text=get_text("luma_switch"))
+        self.luma_switch.pack(pady=5, padx=10)
+
+        # Key baselines from the median of several frames instead of the start frame alone
+        self.robust_calib_switch = ctk.CTkSwitch(self.tab_video, text=get_text("robust_calib_switch"))
+        self.robust_calib_switch.pack(pady=5, padx=10)
+
+        # Key baselines follow fades and slow lighting changes while the keys are released
+        self.baseline_switch = ctk.CTkSwitch(self.tab_video, text=get_text("baseline_switch"))
+        self.baseline_switch.pack(pady=5, padx=10)
+
         self.frames_label = ctk.CTkLabel(self.tab_video, text=get_text("start_frame_label"))
         self.frames_label.pack(pady=(10, 0))
         
@@ -212,6 +248,14 @@ class ModernApp(ctk.CTk):
         self.quantize_value.set("1/16")
         self.quantize_value.pack(side="right")
 
+        # note_on velocity from the brightness delta of each key (curve saved in the calibration)
+        self.velocity_switch = ctk.CTkSwitch(self.tab_midi, text=get_text("velocity_switch"))
+        self.velocity_switch.pack(pady=5, padx=10)
+
+        # New BPM/quantization applied to the notes of the last conversion (no decoding)
+        self.reexport_btn = ctk.CTkButton(self.tab_midi, text=get_text("reexport_btn"), command=self.reexport_midi)
+        self.reexport_btn.pack(pady=10, padx=10, fill="x")
+
         # --- TAB FILTER ---
         self.tab_filter = self.tabview.add(get_text("tab_filter"))
         
@@ -472,12 +516,20 @@ class ModernApp(ctk.CTk):
                     self.tabview._segmented_button._buttons_dict[btn_key].configure(text=get_text(tab_key))
 
         self.load_btn.configure(text=get_text("load_video"))
+        self.save_calib_btn.configure(text=get_text("save_calib_btn"))
+        self.load_calib_btn.configure(text=get_text("load_calib_btn"))
+        self.index_switch.configure(text=get_text("index_switch"))
+        self.luma_switch.configure(text=get_text("luma_switch"))
+        self.robust_calib_switch.configure(text=get_text("robust_calib_switch"))
+        self.baseline_switch.configure(text=get_text("baseline_switch"))
         self.height_slider_label.configure(text=get_text("height_label"))
         self.area_slider_label.configure(text=get_text("area_label"))
         self.threshold_slider_label.configure(text=get_text("threshold_label"))
         self.start_key_label.configure(text=get_text("start_key_label"))
         self.bpm_label.configure(text=get_text("bpm_label"))
         self.quantize_switch.configure(text=get_text("quantize_switch"))
+        self.velocity_switch.configure(text=get_text("velocity_switch"))
+        self.reexport_btn.configure(text=get_text("reexport_btn"))
         self.advanced_label.configure(text=get_text("sensitivity_label"))
         self.white_sens.configure(placeholder_text=get_text("white_placeholder"))
         self.black_sens.configure(placeholder_text=get_text("black_placeholder"))
@@ -731,6 +783,9 @@ class ModernApp(ctk.CTk):
         self.processor.min_contour_area = int(self.min_area_slider.get())
         self.processor.use_intelligent_filter = self.intel_filter_switch.get() == 1
         
+        # Compile LUTs/kernels once here instead of on every filtered frame
+        self.processor.compile_filter_plan()
+        
         # Update labels with current values
         self.hue_label.configure(text=f"{get_text('hue_range')} (Min: {h_min}, Max: {h_max})")
         self.sat_label.configure(text=f"{get_text('sat_range')} (Min: {s_min}, Max: {s_max})")
@@ -920,10 +975,10 @@ class ModernApp(ctk.CTk):
             self.canvas.delete("all")
             return
 
-        # 1. Get Frames
-        self.processor.cap.set(cv2.CAP_PROP_POS_FRAMES, self.preview_frame_idx)
-        ret, frame_orig = self.processor.cap.read()
-        if not ret: return
+        # 1. Get Frames (cached while scrubbing, playback is served without seeking)
+        frame_orig = self.processor.read_frame(self.preview_frame_idx)
+        if frame_orig is None: return
+        frame_orig = frame_orig.copy() # Source frames are shared, overlays are drawn on this one
         
         frame_filtered = self.processor.apply_color_filter(frame_orig.copy())
 
@@ -1003,14 +1058,12 @@ class ModernApp(ctk.CTk):
         if cw < 10 or ch < 10: return
 
         # Resize maintaining aspect ratio
-        h, w = cv_img.shape[:2]
-        ratio = min(cw/w, ch/h)
-        new_w, new_h = int(w*ratio), int(h*ratio)
-        
-        cv_img = cv2.resize(cv_img, (new_w, new_h))
-        cv_img = cv2.cvtColor(cv_img, cv2.COLOR_BGR2RGB)
-        
-        img = Image.fromarray(cv_img)
+        img = Image.fromarray(fit_to_canvas(cv_img, cw, ch))
+        self.display_image(img)
+
+    def display_image(self, img):
+        cw = self.canvas.winfo_width()
+        ch = self.canvas.winfo_height()
         self.tk_img = ImageTk.PhotoImage(image=img)
         
         self.canvas.delete("all")
@@ -1019,6 +1072,131 @@ class ModernApp(ctk.CTk):
     def on_canvas_resize(self, event):
         self.update_preview()
 
+    def read_settings_from_ui(self):
+        """Copies the entry/switch values into the processor. Raises ValueError on invalid input."""
+        self.processor.start_frame = int(self.start_frame_entry.get())
+        self.processor.end_frame = int(self.end_frame_entry.get())
+        self.processor.start_key = int(self.start_key_entry.get())
+        self.processor.bpm = int(self.bpm_entry.get())
+        self.processor.use_quantization = self.quantize_switch.get() == 1
+        self.processor.quantization_value = self.quantize_value.get()
+        self.processor.use_velocity = self.velocity_switch.get() == 1
+        self.processor.white_threshold_factor = float(self.white_sens.get())
+        self.processor.black_threshold_factor = float(self.black_sens.get())
+        self.processor.use_manual_mode = self.manual_switch.get() == 1
+        self.processor.use_index = self.index_switch.get() == 1
+        self.processor.use_luma = self.luma_switch.get() == 1
+        self.processor.calibration_samples = ROBUST_CALIBRATION_SAMPLES if self.robust_calib_switch.get() == 1 else 1
+        if (self.baseline_switch.get() == 1) != (self.processor.baseline_rate > 0):
+            # Keep a custom rate from a calibration file unless the switch was changed
+            self.processor.baseline_rate = TRACKING_BASELINE_RATE if self.baseline_switch.get() == 1 else 0.0
+
+    def apply_settings_to_ui(self):
+        """Moves sliders, entries and switches to the current processor settings."""
+        p = self.processor
+
+        def set_entry(entry, value):
+            entry.delete(0, tk.END)
+            entry.insert(0, str(value))
+
+        def set_switch(switch, value):
+            if value: switch.select()
+            else: switch.deselect()
+
+        self.height_slider.set(p.keyboard_y)
+        self.area_slider.set(p.detection_height)
+        self.threshold_slider.set(p.threshold)
+        set_entry(self.white_sens, p.white_threshold_factor)
+        set_entry(self.black_sens, p.black_threshold_factor)
+        set_entry(self.start_key_entry, p.start_key)
+        set_entry(self.bpm_entry, p.bpm)
+        set_switch(self.quantize_switch, p.use_quantization)
+        self.quantize_value.set(p.quantization_value)
+        set_switch(self.velocity_switch, p.use_velocity)
+        set_switch(self.manual_switch, p.use_manual_mode)
+        set_switch(self.note_names_switch, p.show_note_names)
+        set_switch(self.luma_switch, p.use_luma)
+        set_switch(self.robust_calib_switch, p.calibration_samples > 1)
+        set_switch(self.baseline_switch, p.baseline_rate > 0)
+
+        set_switch(self.filter_switch, p.use_color_filter)
+        self.hue_min_slider.set(int(p.hsv_min[0]))
+        self.sat_min_slider.set(int(p.hsv_min[1]))
+        self.val_min_slider.set(int(p.hsv_min[2]))
+        self.hue_max_slider.set(int(p.hsv_max[0]))
+        self.sat_max_slider.set(int(p.hsv_max[1]))
+        self.val_max_slider.set(int(p.hsv_max[2]))
+        self.contrast_slider.set(p.contrast)
+        self.brightness_slider.set(p.brightness)
+        self.gamma_slider.set(p.gamma)
+        set_switch(self.edge_switch, p.edge_detection)
+        set_switch(self.invert_switch, p.invert_mask)
+        self.blur_slider.set(p.blur_size)
+        self.filter_iter_slider.set(p.filter_iterations)
+        self.dilate_slider.set(p.dilate_iterations)
+        set_switch(self.binary_mask_switch, p.show_binary_mask)
+        set_switch(self.contour_filling_switch, p.use_contour_filling)
+        self.min_area_slider.set(p.min_contour_area)
+        set_switch(self.intel_filter_switch, p.use_intelligent_filter)
+
+        # Re-read the filter widgets so labels are refreshed (also redraws the preview)
+        self.update_filter_params()
+
+    def save_calibration(self):
+        if not self.processor:
+            messagebox.showwarning(get_text("msg_attention"), get_text("error_video"))
+            return
+        try:
+            self.read_settings_from_ui()
+        except ValueError:
+            messagebox.showerror(get_text("msg_error"), get_text("error_params"))
+            return
+
+        path = filedialog.asksaveasfilename(defaultextension=".json", filetypes=[("Calibration", "*.json")])
+        if not path: return
+        self.processor.save_calibration(path)
+        logging.info(f"Calibrazione salvata: {path}")
+        self.status_label.configure(text=get_text("status_calib_saved").format(os.path.basename(path)))
+
+    def reexport_midi(self):
+        if not self.processor or self.processor.note_events is None:
+            messagebox.showwarning(get_text("msg_attention"), get_text("error_no_notes"))
+            return
+        if self.is_converting: return
+        try:
+            self.read_settings_from_ui()
+        except ValueError:
+            messagebox.showerror(get_text("msg_error"), get_text("error_params"))
+            return
+
+        path = filedialog.asksaveasfilename(defaultextension=".mid", filetypes=[
+            ("MIDI files", "*.mid"), ("Notes (NumPy)", "*.npz"), ("Notes (CSV)", "*.csv"), ("Notes (JSON)", "*.json")])
+        if not path: return
+        if not path.lower().endswith((".mid", ".midi")):
+            # Note table (frames, key, brightness delta) for analysis instead of MIDI
+            self.processor.note_events.save(path)
+            logging.info(f"Note salvate: {path}")
+            self.status_label.configure(text=get_text("status_notes_saved").format(os.path.basename(path)))
+            return
+        self.processor.export_midi(path)
+        logging.info(f"MIDI riesportato: {path} (BPM {self.processor.bpm}, quantizzazione {self.processor.use_quantization})")
+        self.status_label.configure(text=get_text("status_reexported").format(os.path.basename(path)))
+
+    def load_calibration(self):
+        if not self.processor:
+            messagebox.showwarning(get_text("msg_attention"), get_text("error_video"))
+            return
+        path = filedialog.askopenfilename(filetypes=[("Calibration", "*.json")])
+        if not path: return
+        try:
+            self.processor.load_calibration(path)
+        except Exception as e:
+            logging.error(f"Error loading calibration {path}: {e}")
+            messagebox.showerror(get_text("msg_error"), get_text("error_calib"))
+            return
+        self.apply_settings_to_ui()
+        self.status_label.configure(text=get_text("status_calib_loaded").format(os.path.basename(path)))
+
     def start_conversion(self):
         if not self.processor:
             messagebox.showwarning(get_text("msg_attention"), get_text("error_video"))
@@ -1032,20 +1210,12 @@ class ModernApp(ctk.CTk):
         if not output_path: return
         
         try:
-            self.processor.start_frame = int(self.start_frame_entry.get())
-            self.processor.end_frame = int(self.end_frame_entry.get())
-            self.processor.start_key = int(self.start_key_entry.get())
-            self.processor.bpm = int(self.bpm_entry.get())
-            self.processor.use_quantization = self.quantize_switch.get() == 1
-            self.processor.quantization_value = self.quantize_value.get()
-            self.processor.white_threshold_factor = float(self.white_sens.get())
-            self.processor.black_threshold_factor = float(self.black_sens.get())
-            self.processor.use_manual_mode = self.manual_switch.get() == 1
+            self.read_settings_from_ui()
             
-            # Recalibrate on start frame before conversion
-            frame = self.processor.get_frame(self.processor.start_frame)
-            if frame is not None:
-                self.processor.analyze_keyboard(frame)
+            # Recalibrate before conversion (the start frame is usually already cached by the preview)
+            self.processor.calibrate()
+            cache = self.processor.frame_cache
+            logging.debug(f"Frame cache: {cache.hits} hit, {cache.misses} miss, {cache.size_bytes / 1048576:.0f} MB")
         except:
             messagebox.showerror(get_text("msg_error"), get_text("error_params"))
             return
@@ -1054,15 +1224,28 @@ class ModernApp(ctk.CTk):
         self.is_converting = True
         self.stop_event.clear()
         
+        # Runtime preview: filtered and resized on a worker with its own filter plan (no lock
+        # shared with the detection thread), shown by a fixed rate UI refresh
+        prepare = FilterPlan(self.processor).apply if self.processor.use_color_filter else None
+        self.preview_renderer = PreviewRenderer(prepare)
+        self.preview_renderer.set_target_size(self.canvas.winfo_width(), self.canvas.winfo_height())
+        self.preview_renderer.start()
+        self.pending_progress = None
+        self.pending_status = None
+        self.refresh_conversion_ui()
+        
         def run():
             try:
                 logging.info(f"Avvio conversione per: {self.processor.video_path}")
+                profiler = StageProfiler()
                 success = self.processor.convert_to_midi(output_path, 
                                                        progress_callback=self.update_progress,
                                                        status_callback=self.update_status_label,
                                                        frame_callback=self.update_runtime_preview,
-                                                       stop_event=self.stop_event)
+                                                       stop_event=self.stop_event,
+                                                       profiler=profiler)
                 logging.info(f"Conversione terminata. Successo: {success}")
+                logging.info(f"Tempi per fase:\n{profiler.summary_table()}")
                 self.after(0, lambda: self.on_conversion_finished(success))
             except Exception as e:
                 logging.error(f"Errore durante la conversione: {e}", exc_info=True)
@@ -1071,18 +1254,46 @@ class ModernApp(ctk.CTk):
         threading.Thread(target=run, daemon=True).start()
 
     def update_progress(self, value):
-        self.after(0, lambda: self.progress_bar.set(value))
+        # Called from the conversion thread: only the latest value is kept for the next UI refresh
+        self.pending_progress = value
 
-    def update_status_label(self, count, total):
+    def update_status_label(self, count, total, info=None):
         text = get_text("status_processing").format(count, total)
-        self.after(0, lambda: self.status_label.configure(text=text))
+        if info and 'decode_queue' in info:
+            # Pipeline throughput and queue depths (full decode queue = analysis is the bottleneck)
+            text += "  " + get_text("status_throughput").format(
+                info['fps'], info['decode_queue'], info['queue_size'], info['detect_queue'], info['queue_size'])
+        self.pending_status = text
 
     def update_runtime_preview(self, frame):
-        # Apply filter if active during conversion
-        if self.processor and self.processor.use_color_filter:
-            frame = self.processor.apply_color_filter(frame)
+        # Never blocks the conversion: an older frame still waiting is replaced by this one
         self.last_preview_frame = frame
-        self.after(0, lambda: self.show_image(frame))
+        if self.preview_renderer:
+            self.preview_renderer.submit(frame)
+
+    def refresh_conversion_ui(self):
+        """Shows the latest progress, status and preview image, then reschedules itself.
+
+        A single pending after() at a time, so the Tk queue stays bounded however fast
+        the conversion reports.
+        """
+        self.ui_refresh_job = None
+        if self.pending_progress is not None:
+            self.progress_bar.set(self.pending_progress)
+            self.pending_progress = None
+        if self.pending_status is not None:
+            self.status_label.configure(text=self.pending_status)
+            self.pending_status = None
+
+        renderer = self.preview_renderer
+        if renderer:
+            renderer.set_target_size(self.canvas.winfo_width(), self.canvas.winfo_height())
+            img = renderer.take()
+            if img is not None:
+                self.display_image(img)
+
+        if self.is_converting:
+            self.ui_refresh_job = self.after(PREVIEW_REFRESH_MS, self.refresh_conversion_ui)
 
     def stop_conversion(self):
         if self.is_converting:
@@ -1091,6 +1302,14 @@ class ModernApp(ctk.CTk):
 
     def on_conversion_finished(self, success):
         self.is_converting = False
+        if self.ui_refresh_job is not None:
+            self.after_cancel(self.ui_refresh_job)
+        self.refresh_conversion_ui() # Last progress/status update
+        if self.preview_renderer:
+            renderer = self.preview_renderer
+            logging.debug(f"Preview: {renderer.submitted} frame, {renderer.rendered} mostrati, {renderer.dropped} scartati")
+            renderer.stop()
+            self.preview_renderer = None
         self.convert_btn.configure(state="normal", text=get_text("start_btn"), fg_color="green", hover_color="darkgreen")
         if success:
             messagebox.showinfo(get_text("msg_success"), get_text("conversion_success"))
@@ -0,0 +1,106 @@
+﻿import os
+import struct
+from note_events import TICKS_PER_BEAT, MidiClock
+
+END_OF_TRACK = b"\x00\xff\x2f\x00" # Delta 0 + end_of_track meta event
+NOTE_OFF, NOTE_ON = 0x80, 0x90 # Status bytes on channel 1
+
+def encode_variable_int(value):
+    """MIDI variable length quantity (7 bits per byte, high bit set on all but the last)."""
+    data = [value & 0x7f]
+    value >>= 7
+    while value:
+        data.append((value & 0x7f) | 0x80)
+        value >>= 7
+    return bytes(reversed(data))
+
+def partial_path_for(path):
+    """Where a streamed MIDI file is written until the conversion completes: <name>.partial.mid."""
+    return os.path.splitext(path)[0] + ".partial.mid"
+
+class MidiStreamWriter:
+    """Single-track MIDI file written while a conversion runs.
+
+    Events are encoded as soon as they are confirmed, with the timing of
+    NoteEvents.to_midi() and the encoding of mido's MidiFile.save() (running status,
+    one end_of_track at the end), so the finished file is byte-identical to an
+    export of the same notes. checkpoint() appends the events since the previous
+    one, a provisional end_of_track and the track length: the file on disk is always
+    a complete, playable MIDI file of everything up to its last checkpoint.
+    The file is written at partial_path_for(path) and moved to path by close(), so an
+    interrupted conversion never leaves a truncated file that looks finished.
+    resume (a state() dict) continues a file written by an interrupted run instead.
+    """
+    def __init__(self, path, fps, start_frame, bpm, use_quantization=False, quantization_value="1/16",
+                 on_velocity=64, off_velocity=127, resume=None):
+        self.path = path
+        self.partial_path = partial_path_for(path)
+        self.clock = MidiClock(fps, start_frame, bpm, use_quantization, quantization_value)
+        self.on_velocity = on_velocity
+        self.off_velocity = off_velocity
+        self.running_status = None
+        self.pending = bytearray() # Encoded events not on disk yet
+        self.track_length = 0 # Bytes of events on disk (without the provisional end_of_track)
+        self.events = 0
+
+        # Header chunk (format 1, one track) and the track chunk header, as mido writes them
+        header = b"MThd" + struct.pack('>L', 6) + struct.pack('>hhh', 1, 1, TICKS_PER_BEAT) + b"MTrk"
+        self.length_offset = len(header)
+        self.data_offset = self.length_offset + 4
+        if resume is None:
+            self.file = open(self.partial_path, 'wb')
+            self.file.write(header + struct.pack('>L', 0))
+        else:
+            self.file = open(self.partial_path, 'r+b')
+            size = os.fstat(self.file.fileno()).st_size
+            if self.file.read(len(header)) != header or size < self.data_offset + resume['track_length']:
+                self.file.close()
+                raise ValueError(f"{self.partial_path} does not match the checkpoint")
+            # Drops the end_of_track and anything written after the checkpoint
+            self.track_length = resume['track_length']
+            self.file.truncate(self.data_offset + self.track_length)
+            self.running_status = resume['running_status']
+            self.clock.last_event_frame = resume['last_event_frame']
+            self.events = resume['events']
+        self.checkpoint()
+
+    def note_on(self, frame, note, velocity=None):
+        self._event(frame, NOTE_ON, note, self.on_velocity if velocity is None else velocity)
+
+    def note_off(self, frame, note, velocity=None):
+        self._event(frame, NOTE_OFF, note, self.off_velocity if velocity is None else velocity)
+
+    def _event(self, frame, status, note, velocity):
+        if not (0 <= note <= 127 and 0 <= velocity <= 127):
+            raise ValueError(f"MIDI note/velocity out of range: {note}/{velocity}")
+        self.pending += encode_variable_int(self.clock.delta_ticks(frame))
+        if status != self.running_status:
+            self.pending.append(status)
+            self.running_status = status
+        self.pending += bytes((note, velocity))
+        self.events += 1
+
+    def checkpoint(self):
+        """Writes the pending events and makes the file on disk a valid MIDI file again."""
+        self.file.seek(self.data_offset + self.track_length)
+        self.file.write(self.pending + END_OF_TRACK)
+        self.track_length += len(self.pending)
+        self.pending = bytearray()
+        self.file.seek(self.length_offset)
+        self.file.write(struct.pack('>L', self.track_length + len(END_OF_TRACK)))
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def state(self):
+        """Position of the stream after the last checkpoint (for resuming a conversion)."""
+        return {'track_length': self.track_length, 'running_status': self.running_status,
+                'last_event_frame': self.clock.last_event_frame, 'events': self.events}
+
+    def close(self, finalize=True):
+        """Writes the last events; finalize moves the file to its final path (the conversion is complete)."""
+        if self.file.closed:
+            return
+        self.checkpoint()
+        self.file.close()
+        if finalize:
+            os.replace(self.partial_path, self.path)
@@ -0,0 +1,196 @@
+﻿import csv
+import json
+import os
+import numpy as np
+from mido import Message, MidiFile, MidiTrack
+
+# Mapping musical values to ticks (ticks_per_beat = 480, which is a quarter note 1/4)
+# Whole note 4/4 = 1920
+# Half note 2/4 = 960
+# Quarter note 1/4 = 480
+# Eighth note 1/8 = 240
+# Sixteenth note 1/16 = 120
+# Thirty-second note 1/32 = 60
+# Sixty-fourth note 1/64 = 30
+QUANT_MAP = {
+    "1/1": 1920, "1/2": 960, "1/4": 480,
+    "1/8": 240, "1/16": 120, "1/32": 60, "1/64": 30
+}
+TICKS_PER_BEAT = 480
+
+# One row per note, in press order
+NOTE_DTYPE = np.dtype([
+    ('note', np.int16), ('key', np.int16), ('on_frame', np.int64), ('off_frame', np.int64), ('delta', np.float64),
+])
+HELD = -1 # off_frame of a note still held at the end
+
+# Velocity model: (brightness delta, velocity) points, linear in between and flat outside.
+# A key just over the default threshold (30) plays soft, a full change from dark to lit plays loud.
+DEFAULT_VELOCITY_CURVE = [[30, 40], [150, 127]]
+
+def velocities(deltas, curve):
+    """MIDI velocities (1-127) of the brightness deltas of pressed keys along curve."""
+    points = np.asarray(curve, dtype=np.float64).reshape(-1, 2)
+    points = points[np.argsort(points[:, 0], kind='stable')]
+    values = np.interp(deltas, points[:, 0], points[:, 1])
+    return np.clip(np.rint(values), 1, 127).astype(np.int64)
+
+class MidiClock:
+    """Turns event frames into MIDI delta ticks (tempo, video fps and optional quantization grid)."""
+    def __init__(self, fps, start_frame, bpm, use_quantization=False, quantization_value="1/16"):
+        # MIDI Timing (based on previous fixes and set BPM)
+        tempo = 60000000 / bpm
+        self.ms_per_tick = tempo / (TICKS_PER_BEAT * 1000)
+        self.ms_per_frame = 1000 / fps
+        self.use_quantization = use_quantization
+        self.quantization_ticks = QUANT_MAP.get(quantization_value, 120) if use_quantization else 1
+        self.last_event_frame = start_frame
+
+    def delta_ticks(self, frame):
+        """Ticks from the previous event to one at frame (which becomes the previous event)."""
+        delta_ms = (frame - self.last_event_frame) * self.ms_per_frame
+        delta_ticks = int(delta_ms / self.ms_per_tick)
+
+        # If quantization is active, round delta_ticks to nearest sixteenth note
+        if self.use_quantization:
+            delta_ticks = round(delta_ticks / self.quantization_ticks) * self.quantization_ticks
+        self.last_event_frame = frame
+        return delta_ticks
+
+class NoteEvents:
+    """Notes found by a conversion, in video frames: the input of the MIDI export stage.
+
+    Detection (decoding, thresholds, debounce) fills this table once; tempo,
+    quantization and velocities are only applied by to_midi(), so trying another
+    BPM or grid does not touch the video again. The notes are one structured NumPy
+    array (NOTE_DTYPE): note, key (index in the key positions), on_frame, off_frame
+    (HELD while still held at the end) and delta (brightness change from the key
+    baseline when it was pressed). It is saved as .npz, .csv or .json and can be
+    queried (between(), key_counts()) without building any MIDI message.
+    """
+    def __init__(self, fps, start_frame=0, notes=None):
+        self.fps = fps
+        self.start_frame = start_frame # Time zero of the MIDI file
+        self._data = np.zeros(256, dtype=NOTE_DTYPE)
+        self._count = 0
+        self.open_notes = {} # key index -> row of the note still held
+        if notes is not None:
+            self.set_notes(notes)
+
+    def __len__(self):
+        return self._count
+
+    @property
+    def notes(self):
+        """The notes as a structured array (a view, valid until the next note_on)."""
+        return self._data[:self._count]
+
+    def set_notes(self, notes):
+        """Replaces the notes with a NOTE_DTYPE array; notes without off_frame are held again."""
+        self._data = np.array(notes, dtype=NOTE_DTYPE)
+        self._count = len(self._data)
+        held = np.flatnonzero(self._data['off_frame'] == HELD)
+        self.open_notes = dict(zip(self._data['key'][held].tolist(), held.tolist()))
+
+    def note_on(self, key, note, frame, delta):
+        if self._count == len(self._data):
+            grown = np.zeros(max(256, 2 * len(self._data)), dtype=NOTE_DTYPE)
+            grown[:self._count] = self._data[:self._count]
+            self._data = grown
+        self._data[self._count] = (note, key, frame, HELD, delta)
+        self.open_notes[key] = self._count
+        self._count += 1
+
+    def note_off(self, key, frame):
+        row = self.open_notes.pop(key, None)
+        if row is not None:
+            self._data['off_frame'][row] = frame
+
+    def _event_order(self):
+        # Rows of the note_on events (all notes) then of the note_off events (released notes), sorted by frame then key
+        notes = self.notes
+        rows = np.concatenate([np.arange(len(notes)), np.flatnonzero(notes['off_frame'] != HELD)])
+        is_on = np.arange(len(rows)) < len(notes)
+        frames = np.where(is_on, notes['on_frame'][rows], notes['off_frame'][rows])
+        order = np.lexsort((notes['key'][rows], frames))
+        return frames[order], rows[order], is_on[order]
+
+    def events(self):
+        """(frame, key, note, is_on) in emission order: by frame, then left to right."""
+        frames, rows, is_on = self._event_order()
+        notes = self.notes
+        return list(zip(frames.tolist(), notes['key'][rows].tolist(), notes['note'][rows].tolist(), is_on.tolist()))
+
+    def seconds(self, frames):
+        """Frame numbers as seconds from the start of the MIDI file."""
+        return (np.asarray(frames) - self.start_frame) / self.fps
+
+    def between(self, start, end):
+        """Notes sounding at some point in [start, end) (seconds from the start of the MIDI file)."""
+        notes = self.notes
+        start_frame = self.start_frame + start * self.fps
+        end_frame = self.start_frame + end * self.fps
+        off = notes['off_frame']
+        return notes[(notes['on_frame'] < end_frame) & ((off == HELD) | (off > start_frame))]
+
+    def key_counts(self, num_keys=0):
+        """Number of notes of every key index (at least num_keys entries)."""
+        return np.bincount(self.notes['key'], minlength=num_keys)
+
+    def to_midi(self, bpm, use_quantization=False, quantization_value="1/16", on_velocity=64, off_velocity=127,
+                velocity_curve=None):
+        """Builds the MIDI file (one track, events timed relative to the previous one).
+
+        With velocity_curve, note_on velocities come from the brightness delta of each
+        note (see velocities()) instead of on_velocity.
+        """
+        mid = MidiFile(ticks_per_beat=TICKS_PER_BEAT)
+        track = MidiTrack()
+        mid.tracks.append(track)
+
+        frames, rows, is_on = self._event_order()
+        notes = self.notes
+        if velocity_curve is not None:
+            on_velocities = velocities(notes['delta'], velocity_curve)[rows].tolist()
+        else:
+            on_velocities = [on_velocity] * len(rows)
+        clock = MidiClock(self.fps, self.start_frame, bpm, use_quantization, quantization_value)
+        for frame, note, on, velocity in zip(frames.tolist(), notes['note'][rows].tolist(), is_on.tolist(), on_velocities):
+            delta_ticks = clock.delta_ticks(frame)
+            if on:
+                track.append(Message('note_on', note=note, velocity=velocity, time=delta_ticks))
+            else:
+                track.append(Message('note_off', note=note, velocity=off_velocity, time=delta_ticks))
+        return mid
+
+    def save(self, path):
+        """Writes the notes as .npz (columns), .csv (one row per note, empty off_frame while held) or .json."""
+        ext = os.path.splitext(path)[1].lower()
+        if ext == ".npz":
+            np.savez(path, notes=self.notes, fps=self.fps, start_frame=self.start_frame)
+        elif ext == ".csv":
+            with open(path, 'w', encoding='utf-8', newline='') as f:
+                writer = csv.writer(f)
+                writer.writerow(NOTE_DTYPE.names)
+                for note, key, on_frame, off_frame, delta in self.notes.tolist():
+                    writer.writerow([note, key, on_frame, "" if off_frame == HELD else off_frame, delta])
+        else:
+            data = {'fps': self.fps, 'start_frame': self.start_frame, 'notes': [
+                {'note': note, 'key': key, 'on_frame': on_frame,
+                 'off_frame': None if off_frame == HELD else off_frame, 'delta': delta}
+                for note, key, on_frame, off_frame, delta in self.notes.tolist()
+            ]}
+            with open(path, 'w', encoding='utf-8') as f:
+                json.dump(data, f, indent=4)
+
+    @classmethod
+    def load(cls, path):
+        """Reads notes saved as .npz or .json."""
+        if path.lower().endswith(".npz"):
+            with np.load(path, allow_pickle=False) as data:
+                return cls(float(data['fps']), int(data['start_frame']), data['notes'])
+        with open(path, 'r', encoding='utf-8-sig') as f:
+            data = json.load(f)
+        notes = [(n['note'], n['key'], n['on_frame'], HELD if n['off_frame'] is None else n['off_frame'], n['delta'])
+                 for n in data['notes']]
+        return cls(data['fps'], data.get('start_frame', 0), np.array(notes, dtype=NOTE_DTYPE))
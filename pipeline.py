@@ -0,0 +1,109 @@
+﻿import queue
+import threading
+
+_END = object() # Marks the end of the stream on a queue
+
+class FramePipeline:
+    """Decode and detection stages on background threads, connected by bounded queues.
+
+    Frames flow decode -> detect -> consumer (the thread iterating the pipeline) in
+    strict order: one thread per stage and FIFO queues, so the debounce logic still
+    sees frames in sequence. A full queue blocks the stage feeding it (backpressure).
+    cv2 releases the GIL while decoding and filtering, so consecutive frames overlap.
+
+    Iterating yields (frame_idx, measurement, frame); frame is None unless
+    keep_frame(frame_idx) is true (e.g. frames needed for the runtime preview).
+    Frames for which measure_frame(frame_idx) is false are not measured: they are
+    passed on as (frame_idx, None, frame) so the consumer can measure them later.
+    """
+    def __init__(self, read_frame, measure, frame_indices, queue_size=8, keep_frame=None, stop_event=None,
+                 measure_frame=None):
+        self.read_frame = read_frame
+        self.measure = measure
+        self.frame_indices = frame_indices
+        self.keep_frame = keep_frame
+        self.measure_frame = measure_frame
+        self.stop_event = stop_event
+
+        self.decoded = queue.Queue(maxsize=queue_size)
+        self.detected = queue.Queue(maxsize=queue_size)
+        self.abort = threading.Event()
+        self.error = None
+        self.threads = []
+
+    def depths(self):
+        """Current (decode, detect) queue depths."""
+        return self.decoded.qsize(), self.detected.qsize()
+
+    def _stopped(self):
+        return self.abort.is_set() or (self.stop_event is not None and self.stop_event.is_set())
+
+    def _put(self, q, item):
+        # Blocks while the queue is full, but gives up if the pipeline is torn down
+        while not self.abort.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _get(self, q):
+        while not self.abort.is_set():
+            try:
+                return q.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        return _END
+
+    def _fail(self, error):
+        if self.error is None:
+            self.error = error
+        self.abort.set()
+
+    def _decode_stage(self):
+        try:
+            for frame_idx in self.frame_indices:
+                if self._stopped(): break
+                frame = self.read_frame(frame_idx)
+                if frame is None: break
+                if not self._put(self.decoded, (frame_idx, frame)): return
+        except Exception as e:
+            self._fail(e)
+        self._put(self.decoded, _END)
+
+    def _detect_stage(self):
+        try:
+            while True:
+                item = self._get(self.decoded)
+                if item is _END: break
+                frame_idx, frame = item
+                if self.measure_frame is None or self.measure_frame(frame_idx):
+                    measurement = self.measure(frame)
+                    keep = frame if self.keep_frame and self.keep_frame(frame_idx) else None
+                else:
+                    measurement, keep = None, frame
+                if not self._put(self.detected, (frame_idx, measurement, keep)): return
+        except Exception as e:
+            self._fail(e)
+        self._put(self.detected, _END)
+
+    def __iter__(self):
+        self.threads = [
+            threading.Thread(target=self._decode_stage, daemon=True),
+            threading.Thread(target=self._detect_stage, daemon=True),
+        ]
+        for t in self.threads:
+            t.start()
+        try:
+            while True:
+                item = self._get(self.detected)
+                if item is _END: break
+                yield item
+            if self.error is not None:
+                raise self.error
+        finally:
+            # Also reached when the consumer stops early (break/exception)
+            self.abort.set()
+            for t in self.threads:
+                t.join()
@@ -0,0 +1,89 @@
+﻿import threading
+import cv2
+from PIL import Image
+
+def fit_to_canvas(cv_img, canvas_w, canvas_h):
+    """Resizes a BGR frame to fit the canvas (aspect ratio kept) and converts it to RGB."""
+    h, w = cv_img.shape[:2]
+    ratio = min(canvas_w / w, canvas_h / h)
+    new_w, new_h = max(1, int(w * ratio)), max(1, int(h * ratio))
+    # Shrink first: the color conversion then runs on the (much smaller) canvas sized image
+    resized = cv2.resize(cv_img, (new_w, new_h))
+    return cv2.cvtColor(resized, cv2.COLOR_BGR2RGB)
+
+class PreviewRenderer:
+    """Turns runtime preview frames into canvas sized PIL images on a worker thread.
+
+    submit() never blocks: it replaces whatever frame is still waiting (latest frame
+    wins), so a slow GUI drops preview frames instead of slowing the conversion down.
+    The Tk thread polls take() at its own refresh rate and only has to wrap the
+    finished image in an ImageTk.PhotoImage (Tk objects must stay on the Tk thread).
+    """
+    def __init__(self, prepare=None):
+        self.prepare = prepare # Optional frame -> frame step run on the worker (e.g. color filter)
+        self.lock = threading.Lock()
+        self.wake = threading.Condition(self.lock)
+        self.pending = None # Latest submitted BGR frame
+        self.ready = None # Latest finished PIL image
+        self.target_size = (0, 0) # Canvas size, updated by the Tk thread
+        self.running = False
+        self.thread = None
+
+        # Statistics
+        self.submitted = 0
+        self.rendered = 0
+        self.dropped = 0
+
+    def start(self):
+        with self.lock:
+            if self.running: return
+            self.running = True
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        with self.wake:
+            self.running = False
+            self.pending = None
+            self.wake.notify()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def set_target_size(self, width, height):
+        self.target_size = (width, height)
+
+    def submit(self, frame):
+        with self.wake:
+            if self.pending is not None:
+                self.dropped += 1
+            self.pending = frame
+            self.submitted += 1
+            self.wake.notify()
+
+    def take(self):
+        """Returns the newest finished image (once), or None if nothing new is ready."""
+        with self.lock:
+            img, self.ready = self.ready, None
+            return img
+
+    def _run(self):
+        while True:
+            with self.wake:
+                while self.running and self.pending is None:
+                    self.wake.wait()
+                if not self.running: return
+                frame, self.pending = self.pending, None
+
+            cw, ch = self.target_size
+            if cw < 10 or ch < 10:
+                continue
+            if self.prepare is not None:
+                frame = self.prepare(frame)
+            img = Image.fromarray(fit_to_canvas(frame, cw, ch))
+
+            with self.lock:
+                if self.ready is not None:
+                    self.dropped += 1 # The GUI did not pick up the previous one in time
+                self.ready = img
+                self.rendered += 1
@@ -0,0 +1,107 @@
+﻿import json
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+
+class StageProfiler:
+    """Wall time per conversion stage plus frame/event counters.
+
+    Stages may run on different threads (see FramePipeline), so their times add up
+    to more than the elapsed time when they overlap.
+    """
+    STAGES = ["seek", "decode", "filter", "strip_reduce", "key_eval", "preview", "midi_append", "checkpoint", "midi_export"]
+
+    def __init__(self):
+        self.totals = {}
+        self.calls = {}
+        self.lock = threading.Lock()
+
+        self.frames = 0 # Frames that went through key evaluation
+        self.frames_dropped = 0 # Requested frames that were never evaluated (decode failure, stop)
+        self.events = 0 # MIDI note events emitted
+        self.t_start = None
+        self.t_end = None
+        self.extra = {} # Additional sections for the report (e.g. filter breakdown)
+
+    def start(self):
+        self.t_start = time.perf_counter()
+
+    def stop(self):
+        self.t_end = time.perf_counter()
+
+    def add(self, stage, seconds):
+        with self.lock:
+            self.totals[stage] = self.totals.get(stage, 0.0) + seconds
+            self.calls[stage] = self.calls.get(stage, 0) + 1
+
+    @contextmanager
+    def stage(self, name):
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - t0)
+
+    def elapsed(self):
+        if self.t_start is None:
+            return 0.0
+        end = self.t_end if self.t_end is not None else time.perf_counter()
+        return end - self.t_start
+
+    def to_dict(self):
+        elapsed = self.elapsed()
+        stages = {}
+        for name in self.STAGES + sorted(set(self.totals) - set(self.STAGES)):
+            if name not in self.totals:
+                continue
+            total, calls = self.totals[name], self.calls[name]
+            stages[name] = {
+                "total_s": total,
+                "calls": calls,
+                "avg_ms": total * 1000.0 / calls if calls else 0.0,
+                "share": total / elapsed if elapsed > 0 else 0.0,
+            }
+        report = {
+            "elapsed_s": elapsed,
+            "frames": self.frames,
+            "frames_dropped": self.frames_dropped,
+            "fps": self.frames / elapsed if elapsed > 0 else 0.0,
+            "events": self.events,
+            "events_per_s": self.events / elapsed if elapsed > 0 else 0.0,
+            "stages": stages,
+        }
+        report.update(self.extra)
+        return report
+
+    def save_json(self, path):
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(self.to_dict(), f, indent=4)
+
+    def summary_table(self):
+        """Human readable table of the stage times (largest first)."""
+        report = self.to_dict()
+        lines = [
+            f"{'stage':<14}{'total s':>10}{'calls':>9}{'avg ms':>10}{'share':>8}",
+            "-" * 51,
+        ]
+        for name, s in sorted(report["stages"].items(), key=lambda kv: -kv[1]["total_s"]):
+            lines.append(f"{name:<14}{s['total_s']:>10.3f}{s['calls']:>9}{s['avg_ms']:>10.3f}{s['share']:>7.0%}")
+        lines.append("-" * 51)
+        lines.append(
+            f"{report['frames']} frames in {report['elapsed_s']:.2f} s ({report['fps']:.1f} fps), "
+            f"{report['frames_dropped']} dropped, {report['events']} events ({report['events_per_s']:.1f}/s)"
+        )
+        return "\n".join(lines)
+
+class NullProfiler:
+    """Drop-in for StageProfiler when profiling is off (no timing calls at all)."""
+    frames = frames_dropped = events = 0
+
+    def start(self): pass
+    def stop(self): pass
+    def add(self, stage, seconds): pass
+
+    def stage(self, name):
+        return nullcontext()
+
+NULL_PROFILER = NullProfiler()
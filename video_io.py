@@ -0,0 +1,118 @@
+﻿import threading
+import time
+from collections import deque, OrderedDict
+
+class FrameSource:
+    """Random-access frame reader on top of a decoder (see decoders.py) that avoids needless seeks.
+
+    Seeking makes the decoder restart from the previous keyframe, which on long-GOP
+    H.264/HEVC files costs far more than decoding the next frame. Requests for the
+    next frame are served with a plain read, short forward jumps by grabbing the
+    frames in between, and recently decoded frames come from a small ring buffer
+    (e.g. stepping back with the arrow keys). Returned frames are shared, read-only
+    arrays: copy them before drawing on them.
+    """
+    def __init__(self, decoder, buffer_size=8, max_grab_ahead=16):
+        self.decoder = decoder
+        self.buffer_size = buffer_size
+        self.max_grab_ahead = max_grab_ahead # Larger forward jumps use a real seek
+        self.recent = deque(maxlen=buffer_size) # (frame_idx, frame)
+        self.next_idx = 0 # Index of the frame the next decoder.read() returns (-1 = unknown)
+        self.lock = threading.Lock()
+        self.profiler = None # Optional StageProfiler timing the "seek" and "decode" stages
+
+        # Statistics
+        self.reads = 0
+        self.seeks = 0
+        self.buffer_hits = 0
+
+    def read(self, frame_idx):
+        """Returns frame frame_idx (read-only) or None if it cannot be decoded."""
+        with self.lock:
+            for idx, frame in reversed(self.recent):
+                if idx == frame_idx:
+                    self.buffer_hits += 1
+                    return frame
+
+            profiler = self.profiler
+            t0 = time.perf_counter() if profiler else 0.0
+            gap = frame_idx - self.next_idx
+            if self.next_idx < 0 or gap < 0 or gap > self.max_grab_ahead:
+                self.decoder.seek(frame_idx)
+                self.seeks += 1
+                if profiler:
+                    t1 = time.perf_counter()
+                    profiler.add("seek", t1 - t0)
+                    t0 = t1
+            else:
+                # Short jump forward: grab() skips the color conversion of the frames in between
+                for _ in range(gap):
+                    if not self.decoder.grab():
+                        self.next_idx = -1
+                        return None
+
+            frame = self.decoder.read()
+            self.reads += 1
+            if profiler:
+                profiler.add("decode", time.perf_counter() - t0)
+            if frame is None:
+                self.next_idx = -1
+                return None
+
+            frame.flags.writeable = False
+            self.recent.append((frame_idx, frame))
+            self.next_idx = frame_idx + 1
+            return frame
+
+    def clear(self):
+        with self.lock:
+            self.recent.clear()
+            self.next_idx = -1
+
+class FrameCache:
+    """LRU cache of decoded frames keyed by frame index, bounded by memory rather than frame count.
+
+    A 4K BGR frame is about 25 MB, so a frame-count limit would either waste RAM on
+    small videos or blow up on large ones.
+    """
+    def __init__(self, max_mb=512):
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self.frames = OrderedDict() # frame_idx -> frame, least recently used first
+        self.size_bytes = 0
+        self.lock = threading.Lock()
+
+        # Statistics
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, frame_idx):
+        with self.lock:
+            frame = self.frames.get(frame_idx)
+            if frame is None:
+                self.misses += 1
+                return None
+            self.frames.move_to_end(frame_idx)
+            self.hits += 1
+            return frame
+
+    def put(self, frame_idx, frame):
+        if frame.nbytes > self.max_bytes:
+            return
+        with self.lock:
+            old = self.frames.pop(frame_idx, None)
+            if old is not None:
+                self.size_bytes -= old.nbytes
+            self.frames[frame_idx] = frame
+            self.size_bytes += frame.nbytes
+            while self.size_bytes > self.max_bytes:
+                _, evicted = self.frames.popitem(last=False)
+                self.size_bytes -= evicted.nbytes
+
+    def clear(self):
+        with self.lock:
+            self.frames.clear()
+            self.size_bytes = 0
+
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0